@@ -3,14 +3,15 @@ import logging
 import json
 import os
 import utils
+import local_pipeline
 from pathlib import Path
 
 
 def main():
     # Retrieving arguments
     parser = argparse.ArgumentParser(description='Continous integration in Saagie Project')
-    parser.add_argument("--action", type=str, choices=['package_job', 'update_job', 'update_pipeline'],
-                        help="Action to do with job: 'package_job', 'update_job', 'update_pipeline'",
+    parser.add_argument("--action", type=str, choices=['package_job', 'update_job', 'update_pipeline', 'run_pipeline_local'],
+                        help="Action to do with job: 'package_job', 'update_job', 'update_pipeline', 'run_pipeline_local'",
                         required=True)
     parser.add_argument("--job_name", type=str,
                         help="Name of the job", required=False)
@@ -34,8 +35,14 @@ def main():
                         help="Folder where env config files are stored", default="./saagie/envs/*.json")
     parser.add_argument("--job_source_folder", type=str,
                         help="Folder where job source files are stored", default="./code/jobs/*/*")
+    parser.add_argument("--common_source_folder", type=str,
+                        help="Folder of the code shared by every job, added to each job archive", default="./code/common")
     parser.add_argument("--artefact_code_folder", type=str,
                         help="Folder where artefact code files are stored", default="./dist/*/*")
+    parser.add_argument("--local_log_folder", type=str,
+                        help="Folder where the output of each job is written by run_pipeline_local", default="./local_run_logs")
+    parser.add_argument("--max_workers", type=int,
+                        help="Maximum number of jobs running at the same time with run_pipeline_local", default=4)
     parser.add_argument("--debug", help="Enable debug mode", action="store_const",
                         dest="loglevel", const=logging.DEBUG, default=logging.INFO)
 
@@ -55,12 +62,28 @@ def main():
 
     if args.action == "package_job":
         if job_config["file_path"]:
-            utils.package_code(Path(args.artefact_code_folder).parents[1] / args.job_name / args.job_name, Path(args.job_source_folder).parents[1] / args.job_name)
+            extra_dirs = [Path(args.common_source_folder)] if Path(args.common_source_folder).is_dir() else None
+            utils.package_code(Path(args.artefact_code_folder).parents[1] / args.job_name / args.job_name,
+                               Path(args.job_source_folder).parents[1] / args.job_name,
+                               extra_dirs=extra_dirs)
             logging.info(f"Successfully package job: [{args.job_name}]")
         else:
             logging.info(f"There is no corresponding artefact path for the job: [{args.job_name}]")
         return
 
+    if args.action == "run_pipeline_local":
+        results = local_pipeline.run_pipeline_local(Path(args.pipeline_config_folder).parents[0] / f"{args.pipeline_name}.json",
+                                                    args.saagie_env,
+                                                    args.job_config_folder,
+                                                    Path(args.job_source_folder).parents[1],
+                                                    args.common_source_folder,
+                                                    args.local_log_folder,
+                                                    args.max_workers)
+        if any(result["status"] == local_pipeline.FAILED for result in results.values()):
+            logging.error("At least one job of the pipeline failed")
+            exit(1)
+        return
+
     # Retrieving environment config
     with open(Path(args.env_config_folder).parents[0] / f"{args.saagie_env}.json", "r") as f:
         env_config = json.load(f)
@@ -0,0 +1,321 @@
+import ast
+import glob
+import json
+import logging
+import operator
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import utils
+
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+SKIPPED = "SKIPPED"
+
+_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.Mod: operator.mod, ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+
+
+def load_job_configs(job_config_folder):
+    """
+    Index job config files by job name
+    :param job_config_folder: str, glob of job config files, e.g. "./saagie/jobs/*.json"
+    :return: dict, job name to (job code name, job config)
+    """
+    job_configs = {}
+    for job_config_file in sorted(glob.glob(job_config_folder)):
+        with open(job_config_file, "r", encoding="utf8") as f:
+            job_config = json.load(f)
+        job_configs[job_config["job_name"]] = (Path(job_config_file).stem, job_config)
+    return job_configs
+
+
+def evaluate_expression(expression, variables=None):
+    """
+    Evaluate a simple expression condition: arithmetic, comparisons, boolean operators (CEL && || ! are accepted)
+    and variables, without executing arbitrary code
+    :param expression: str, expression of the condition, e.g. "1 + 1 == 2"
+    :param variables: dict, values of the names used in the expression
+    :return: bool, value of the expression
+    """
+    variables = variables or {}
+    python_expression = re.sub(r"!(?!=)", " not ", expression.replace("&&", " and ").replace("||", " or "))
+    python_expression = re.sub(r"\btrue\b", "True", re.sub(r"\bfalse\b", "False", python_expression))
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id not in variables:
+                raise ValueError(f"Unknown variable in expression: [{node.id}]")
+            return variables[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+            return _OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATORS:
+            return _OPERATORS[type(node.op)](evaluate(node.operand))
+        if isinstance(node, ast.BoolOp):
+            values = [evaluate(value) for value in node.values]
+            return all(values) if isinstance(node.op, ast.And) else any(values)
+        if isinstance(node, ast.Compare):
+            left = evaluate(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in _OPERATORS:
+                    raise ValueError(f"Unsupported operator in expression: [{expression}]")
+                right = evaluate(comparator)
+                if not _OPERATORS[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        raise ValueError(f"Unsupported expression: [{expression}]")
+
+    return bool(evaluate(ast.parse(python_expression.strip(), mode="eval")))
+
+
+def evaluate_status(value, parent_statuses):
+    """
+    Evaluate a status condition on the statuses of the incoming edges
+    :param value: str, "AllSuccess", "AllSuccessOrSkipped" or "AtLeastOneSuccess"
+    :param parent_statuses: list, status of each incoming edge
+    :return: bool, value of the condition
+    """
+    if value == "AllSuccess":
+        return all(status == SUCCEEDED for status in parent_statuses)
+    if value == "AllSuccessOrSkipped":
+        return all(status in (SUCCEEDED, SKIPPED) for status in parent_statuses)
+    if value == "AtLeastOneSuccess":
+        return any(status == SUCCEEDED for status in parent_statuses)
+    raise ValueError(f"Unknown status condition: [{value}]")
+
+
+def compile_graph(pipeline_info):
+    """
+    Compile the graph pipeline into nodes and edges
+    A job activates its next nodes when it succeeds, a condition activates its success or failure nodes
+    :param pipeline_info: dict, graph pipeline with "job_nodes" and "condition_nodes"
+    :return: tuple, dict of node ID to node info, dict of node ID to list of (parent ID, edge kind)
+    """
+    nodes = {}
+    parents = {}
+    for job_node_info in pipeline_info["job_nodes"]:
+        nodes[job_node_info["id"]] = dict(job_node_info, kind="job")
+    for condition_node_info in pipeline_info["condition_nodes"]:
+        nodes[condition_node_info["id"]] = dict(condition_node_info, kind="condition")
+    for node_id in nodes:
+        parents[node_id] = []
+    for node_id, node in nodes.items():
+        if node["kind"] == "job":
+            edges = [(next_id, "next") for next_id in node["next_nodes"]]
+        else:
+            edges = [(next_id, "success") for next_id in node["next_nodes_success"]] + \
+                    [(next_id, "failure") for next_id in node["next_nodes_failure"]]
+        for next_id, edge_kind in edges:
+            if next_id not in nodes:
+                raise ValueError(f"Node [{node_id}] points to an unknown node: [{next_id}]")
+            parents[next_id].append((node_id, edge_kind))
+    return nodes, parents
+
+
+def job_command(job_code_name, job_config, job_code_folder):
+    """
+    Build the command of a job from its command_line, {file} being the job code directory
+    :param job_code_name: str, name of the job directory in the code folder
+    :param job_config: dict, job config
+    :param job_code_folder: str, folder containing the code of every job
+    :return: str, command to run with bash
+    """
+    command_line = job_config.get("command_line") or ""
+    return command_line.replace("{file}", str(Path(job_code_folder) / job_code_name))
+
+
+class LocalPipelineRunner(object):
+    """Run a graph pipeline locally, each job as a subprocess, independent branches in parallel"""
+    def __init__(self, pipeline_info, job_configs, job_code_folder="./code/jobs", common_code_folder="./code/common",
+                 log_folder="./local_run_logs", max_workers=4):
+        """
+        :param pipeline_info: dict, graph pipeline with "job_nodes" and "condition_nodes"
+        :param job_configs: dict, job name to (job code name, job config), see load_job_configs
+        :param job_code_folder: str, folder containing the code of every job
+        :param common_code_folder: str, folder of the code shared by every job, added to PYTHONPATH
+        :param log_folder: str, folder where the output of each job is written
+        :param max_workers: int, maximum number of jobs running at the same time
+        """
+        self.nodes, self.parents = compile_graph(pipeline_info)
+        self.job_configs = job_configs
+        self.job_code_folder = job_code_folder
+        self.common_code_folder = common_code_folder
+        self.log_folder = log_folder
+        self.max_workers = max_workers
+        self.results = {}
+        for node in self.nodes.values():
+            if node["kind"] == "job" and node["job_name"] not in job_configs:
+                raise ValueError(f"No job config file for the job: [{node['job_name']}]")
+
+    def _edge_status(self, parent_id, edge_kind):
+        parent = self.results[parent_id]
+        if parent["status"] == SKIPPED:
+            return SKIPPED
+        if edge_kind == "next":
+            return parent["status"]
+        activated = parent["value"] if edge_kind == "success" else not parent["value"]
+        return SUCCEEDED if activated else SKIPPED
+
+    def _run_job(self, node_id):
+        node = self.nodes[node_id]
+        job_code_name, job_config = self.job_configs[node["job_name"]]
+        command = job_command(job_code_name, job_config, self.job_code_folder)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(Path(self.common_code_folder).resolve()),
+                                                          env.get("PYTHONPATH")]))
+        log_file = Path(self.log_folder) / f"{job_code_name}-{node_id}.log"
+        logging.info(f"Running job: [{node['job_name']}] ...")
+        start = time.time()
+        with open(log_file, "w", encoding="utf8") as f:
+            return_code = subprocess.call(["bash", "-c", command], stdout=f, stderr=subprocess.STDOUT, env=env)
+        status = SUCCEEDED if return_code == 0 else FAILED
+        logging.info(f"Job [{node['job_name']}] {status} in {time.time() - start:.1f}s, logs: {log_file}")
+        return {"status": status, "start": start, "end": time.time(), "log_file": str(log_file)}
+
+    def _settle_condition(self, node_id, parent_statuses):
+        node = self.nodes[node_id]
+        now = time.time()
+        result = {"status": SUCCEEDED, "start": now, "end": now}
+        try:
+            if node["condition_type"] == "status":
+                result["value"] = evaluate_status(node["value"], parent_statuses)
+            else:
+                result["value"] = evaluate_expression(node["value"], dict(os.environ))
+        except Exception as e:
+            logging.warning(f"Condition [{node_id}] cannot be evaluated, following failure nodes: {e}")
+            result["value"] = False
+        logging.info(f"Condition [{node['value']}] is {result['value']}")
+        return result
+
+    def run(self):
+        """
+        Run the pipeline until every node is done or skipped
+        :return: dict, node ID to result with "status", "start" and "end"
+        """
+        os.makedirs(self.log_folder, exist_ok=True)
+        self.start = time.time()
+        pending = set(self.nodes)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                progress = False
+                for node_id in sorted(pending):
+                    if not all(parent_id in self.results for parent_id, _ in self.parents[node_id]):
+                        continue
+                    pending.discard(node_id)
+                    progress = True
+                    parent_statuses = [self._edge_status(parent_id, edge_kind)
+                                       for parent_id, edge_kind in self.parents[node_id]]
+                    node = self.nodes[node_id]
+                    if node["kind"] == "condition":
+                        if parent_statuses and all(status == SKIPPED for status in parent_statuses):
+                            self.results[node_id] = {"status": SKIPPED, "start": None, "end": None}
+                        elif node["condition_type"] == "expression" and \
+                                any(status != SUCCEEDED for status in parent_statuses):
+                            self.results[node_id] = {"status": SKIPPED, "start": None, "end": None}
+                        else:
+                            self.results[node_id] = self._settle_condition(node_id, parent_statuses)
+                    elif all(status == SUCCEEDED for status in parent_statuses):
+                        running[executor.submit(self._run_job, node_id)] = node_id
+                    else:
+                        self.results[node_id] = {"status": SKIPPED, "start": None, "end": None}
+                if progress:
+                    # Settled conditions and skipped nodes may have unblocked other nodes
+                    continue
+                if not running:
+                    raise ValueError(f"The pipeline has a cycle between nodes: {sorted(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.results[running.pop(future)] = future.result()
+        self.end = time.time()
+        return self.results
+
+    def critical_path(self):
+        """
+        Find the chain of nodes with the longest total duration
+        :return: tuple, list of node IDs and total duration in seconds
+        """
+        finish = {}
+        previous = {}
+
+        def duration(node_id):
+            result = self.results.get(node_id, {})
+            return result["end"] - result["start"] if result.get("start") is not None else 0.0
+
+        def longest(node_id):
+            if node_id not in finish:
+                best_parent = max((parent_id for parent_id, _ in self.parents[node_id]),
+                                  key=longest, default=None)
+                previous[node_id] = best_parent
+                finish[node_id] = duration(node_id) + (finish[best_parent] if best_parent else 0.0)
+            return finish[node_id]
+
+        last = max(self.nodes, key=longest)
+        path = []
+        while last is not None:
+            path.append(last)
+            last = previous[last]
+        return path[::-1], finish[path[0]]
+
+    def report(self):
+        """
+        Log the timing of each node and the critical path
+        :return: str, report
+        """
+        lines = [f"{'Node':<40} {'Status':<10} {'Start':>8} {'Duration':>9}"]
+        for node_id, result in sorted(self.results.items(), key=lambda item: item[1]["start"] or float("inf")):
+            node = self.nodes[node_id]
+            name = node["job_name"] if node["kind"] == "job" else f"[{node['condition_type']}] {node['value']}"
+            # Evaluated conditions show their value instead of their status
+            status = str(result["value"]).upper() if "value" in result else result["status"]
+            if result["start"] is None:
+                lines.append(f"{name[:40]:<40} {status:<10} {'-':>8} {'-':>9}")
+            else:
+                lines.append(f"{name[:40]:<40} {status:<10} {result['start'] - self.start:>7.1f}s "
+                             f"{result['end'] - result['start']:>8.1f}s")
+        path, path_duration = self.critical_path()
+        total_jobs = sum(result["end"] - result["start"] for node_id, result in self.results.items()
+                         if self.nodes[node_id]["kind"] == "job" and result["start"] is not None)
+        lines.append(f"Wall time: {self.end - self.start:.1f}s - sum of job durations: {total_jobs:.1f}s")
+        lines.append(f"Critical path ({path_duration:.1f}s): " +
+                     " -> ".join(self.nodes[node_id].get("job_name") or f"[{self.nodes[node_id]['value']}]"
+                                 for node_id in path))
+        report = "\n".join(lines)
+        logging.info("Local pipeline report:\n" + report)
+        return report
+
+
+def run_pipeline_local(pipeline_config_file, env, job_config_folder, job_code_folder, common_code_folder,
+                       log_folder, max_workers):
+    """
+    Run a pipeline locally, without Saagie
+    :param pipeline_config_file: str, pipeline config file path
+    :param env: str, environment of the graph pipeline
+    :param job_config_folder: str, glob of job config files
+    :param job_code_folder: str, folder containing the code of every job
+    :param common_code_folder: str, folder of the code shared by every job
+    :param log_folder: str, folder where the output of each job is written
+    :param max_workers: int, maximum number of jobs running at the same time
+    :return: dict, node ID to result, the pipeline succeeded if no job failed
+    """
+    with open(pipeline_config_file, "r", encoding="utf8") as f:
+        pipeline_config = json.load(f)
+    pipeline_info = utils.load_pipeline_info(pipeline_config["file_path"], env)
+    runner = LocalPipelineRunner(pipeline_info, load_job_configs(job_config_folder), job_code_folder,
+                                 common_code_folder, log_folder, max_workers)
+    results = runner.run()
+    runner.report()
+    return results
@@ -4,6 +4,7 @@ from saagieapi import SaagieApi, GraphPipeline, ConditionNode, JobNode, Conditio
 import json
 import shutil
 import os
+import tempfile
 import yaml
 from pathlib import Path
 
@@ -14,17 +15,26 @@ def handle_log_error(msg, exception):
     raise exception
 
 
-def package_code(name_file, root_dir, archive_format="zip"):
+def package_code(name_file, root_dir, archive_format="zip", extra_dirs=None):
     """
     Create a zip archive of a directory
     :param name_file: string, name of the file to create, including the path, minus any format-specific extension
     :param root_dir: string, a directory that will be the root directory of the archive
     :param archive_format: string, archive format, can be "zip", "tar", "gztar", "bztar" or "bztar"
+    :param extra_dirs: list, directories whose content is also put at the root of the archive, e.g. shared code,
+    files of root_dir take precedence
     :return: string, name of the archive
     """
     if root_dir:
         logging.info(f"Creating archive: {name_file}.{archive_format} ...")
-        return shutil.make_archive(name_file, archive_format, root_dir)
+        if not extra_dirs:
+            return shutil.make_archive(name_file, archive_format, root_dir)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for directory in list(extra_dirs) + [root_dir]:
+                logging.debug(f"Adding {directory} to the archive ...")
+                shutil.copytree(directory, tmp_dir, dirs_exist_ok=True,
+                                ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+            return shutil.make_archive(name_file, archive_format, tmp_dir)
     else:
         return None
 
@@ -122,12 +132,12 @@ def run_job(client_saagie, job_config_file, env_config_file):
     return client_saagie.jobs.run(job_id)
 
 
-def create_graph(pipeline_config_file, env):
+def load_pipeline_info(pipeline_config_file, env):
     """
-    Create the Graph of Saagie graph pipeline
-    :param pipeline_config_file: str, pipeline config file path
-    :param env: str, environment of Saagie that you want upgrade pipeline
-    :return: saagieapi.GraphPipeline
+    Load the graph pipeline of an environment from a pipeline config file
+    :param pipeline_config_file: str, pipeline config file path, json or yaml
+    :param env: str, environment of the graph pipeline
+    :return: dict, graph pipeline with "job_nodes" and "condition_nodes"
     """
     file_extension = Path(pipeline_config_file).suffix
     logging.debug(f"Loading pipeline config file: [{pipeline_config_file}] ...")
@@ -139,8 +149,17 @@ def create_graph(pipeline_config_file, env):
             pipeline_config = yaml.safe_load(f)
     else:
         raise Exception("Pipeline artefact file must be a json or yaml file")
+    return pipeline_config["env"][env]["graph_pipeline"]
+
 
-    pipeline_info = pipeline_config["env"][env]["graph_pipeline"]
+def create_graph(pipeline_config_file, env):
+    """
+    Create the Graph of Saagie graph pipeline
+    :param pipeline_config_file: str, pipeline config file path
+    :param env: str, environment of Saagie that you want upgrade pipeline
+    :return: saagieapi.GraphPipeline
+    """
+    pipeline_info = load_pipeline_info(pipeline_config_file, env)
     graph_pipeline = GraphPipeline()
     list_job_nodes = []
     list_condition_nodes = []
@@ -0,0 +1,277 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import s3fs
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "_manifest.json"
+# S3 refuses multipart parts smaller than 5MiB, except the last one
+MIN_PART_SIZE = 5 * 2 ** 20
+# Cache entries used recently may have been returned to a job that has not opened them yet
+EVICTION_GRACE_SECONDS = 600
+LOCK_NAME = ".lock"
+
+
+class S3Store(object):
+    """
+    Access to the datalake bucket shared by the pipeline jobs: parallel multipart transfers with retries,
+    a content-addressed local read-through cache and snapshots resolved by manifest
+    """
+    def __init__(self, bucket, key=None, secret=None, endpoint_url=None, cache_dir=None, cache_max_bytes=5 * 2 ** 30,
+                 max_workers=8, part_size=16 * 2 ** 20, max_retries=3, backoff_factor=0.5):
+        """
+        :param bucket: string, name of the bucket
+        :param key: string, S3 access key
+        :param secret: string, S3 secret key
+        :param endpoint_url: string, URL of an S3 compatible endpoint (MinIO, moto server), AWS if None
+        :param cache_dir: string, directory of the local cache, a temporary directory by default
+        :param cache_max_bytes: int, maximum size of the local cache, least recently used files are evicted
+        :param max_workers: int, number of parts transferred in parallel
+        :param part_size: int, size of the parts of multipart transfers in bytes
+        :param max_retries: int, number of retries of a failed request
+        :param backoff_factor: float, backoff factor between retries in seconds
+        """
+        self.bucket = bucket.strip('/')
+        self.fs = s3fs.S3FileSystem(key=key, secret=secret,
+                                    client_kwargs={'endpoint_url': endpoint_url} if endpoint_url else None)
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 's3_cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_max_bytes = cache_max_bytes
+        self.max_workers = max_workers
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.counters = {'bytes_downloaded': 0, 'bytes_uploaded': 0, 'download_time': 0.0, 'upload_time': 0.0,
+                         'cache_hits': 0, 'cache_misses': 0, 'retries': 0}
+
+    def url(self, path):
+        """
+        :param path: string, path inside the bucket, with or without leading '/'
+        :return: string, s3:// URL of the path
+        """
+        return f"s3://{self.bucket}/{path.lstrip('/')}"
+
+    def _key(self, path):
+        return path.lstrip('/')
+
+    def _retry(self, function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except FileNotFoundError:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                self.counters['retries'] += 1
+                logger.warning(f"S3 request failed ({e}), retrying in {self.backoff_factor * 2 ** attempt:.1f}s ...")
+                time.sleep(self.backoff_factor * 2 ** attempt)
+
+    def exists(self, path):
+        self.fs.invalidate_cache(self.url(path))
+        return self.fs.exists(self.url(path))
+
+    def info(self, path):
+        self.fs.invalidate_cache(self.url(path))
+        return self._retry(self.fs.info, self.url(path))
+
+    # Downloads
+    def _cache_path(self, info):
+        # The ETag identifies the content of the object, so identical objects share one cache entry
+        digest = hashlib.sha256(f"{info.get('ETag', '')}:{info['size']}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def _evict(self, keep):
+        """
+        Remove the least recently used entries until the cache fits in cache_max_bytes
+        The cache directory may be shared by jobs running concurrently, so evictions are serialized by a lock file
+        and entries used less than EVICTION_GRACE_SECONDS ago are never removed
+        :param keep: string, path of the entry being returned to the caller, never removed
+        """
+        with open(os.path.join(self.cache_dir, LOCK_NAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.name != LOCK_NAME and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            min_mtime = time.time() - EVICTION_GRACE_SECONDS
+            for mtime, size, path in sorted(entries):
+                if total <= self.cache_max_bytes or mtime > min_mtime:
+                    break
+                if path == keep:
+                    continue
+                os.remove(path)
+                total -= size
+
+    def _download_parts(self, path, local_path, size):
+        url = self.url(path)
+        ranges = [(start, min(start + self.part_size, size)) for start in range(0, size, self.part_size)]
+        with open(local_path, 'wb') as f:
+            f.truncate(size)
+
+        def download_part(byte_range):
+            data = self._retry(self.fs.cat_file, url, start=byte_range[0], end=byte_range[1])
+            with open(local_path, 'r+b') as f:
+                f.seek(byte_range[0])
+                f.write(data)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(download_part, ranges))
+
+    def download(self, path):
+        """
+        Download an object through the local cache
+        :param path: string, path inside the bucket
+        :return: string, local path of the cached file, to be read only
+        """
+        info = self.info(path)
+        local_path = self._cache_path(info)
+        try:
+            # Mark the entry as recently used, which also protects it from the evictions of other jobs
+            os.utime(local_path)
+            self.counters['cache_hits'] += 1
+            return local_path
+        except FileNotFoundError:
+            pass
+
+        self.counters['cache_misses'] += 1
+        start = time.time()
+        part_path = f"{local_path}.{uuid.uuid4().hex}.part"
+        try:
+            self._download_parts(path, part_path, info['size'])
+            os.replace(part_path, local_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        self.counters['download_time'] += time.time() - start
+        self.counters['bytes_downloaded'] += info['size']
+        logger.info(f"Downloaded {self.url(path)}: {info['size'] / 2 ** 20:.1f}MiB in {time.time() - start:.1f}s")
+        self._evict(keep=local_path)
+        return local_path
+
+    def read_json(self, path):
+        """
+        Read a small json object without caching it
+        :param path: string, path inside the bucket
+        :return: object, parsed json
+        """
+        self.fs.invalidate_cache(self.url(path))
+        return json.loads(self._retry(self.fs.cat_file, self.url(path)))
+
+    # Uploads
+    def _upload_parts(self, local_path, path, size):
+        key = self._key(path)
+        upload_id = self._retry(self.fs.call_s3, 'create_multipart_upload', Bucket=self.bucket, Key=key)['UploadId']
+
+        def upload_part(part_number):
+            with open(local_path, 'rb') as f:
+                f.seek((part_number - 1) * self.part_size)
+                data = f.read(self.part_size)
+            response = self._retry(self.fs.call_s3, 'upload_part', Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                   PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+        try:
+            nb_parts = (size + self.part_size - 1) // self.part_size
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                parts = list(executor.map(upload_part, range(1, nb_parts + 1)))
+            self._retry(self.fs.call_s3, 'complete_multipart_upload', Bucket=self.bucket, Key=key,
+                        UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            self.fs.call_s3('abort_multipart_upload', Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def upload(self, local_path, path):
+        """
+        Upload a local file, in parallel parts if it is bigger than part_size
+        :param local_path: string, path of the local file
+        :param path: string, path inside the bucket
+        """
+        size = os.path.getsize(local_path)
+        start = time.time()
+        if size > self.part_size:
+            self._upload_parts(local_path, path, size)
+        else:
+            with open(local_path, 'rb') as f:
+                data = f.read()
+            self._retry(self.fs.call_s3, 'put_object', Bucket=self.bucket, Key=self._key(path), Body=data)
+        self.fs.invalidate_cache(self.url(path))
+        self.counters['upload_time'] += time.time() - start
+        self.counters['bytes_uploaded'] += size
+        logger.info(f"Uploaded {self.url(path)}: {size / 2 ** 20:.1f}MiB in {time.time() - start:.1f}s")
+
+    def write_json(self, obj, path):
+        """
+        Write a small json object
+        :param obj: object, json serializable
+        :param path: string, path inside the bucket
+        """
+        self._retry(self.fs.call_s3, 'put_object', Bucket=self.bucket, Key=self._key(path),
+                    Body=json.dumps(obj, indent=2).encode('utf-8'))
+        self.fs.invalidate_cache(self.url(path))
+
+    # Snapshots
+    def publish_snapshot(self, prefix, files):
+        """
+        Upload files as a new snapshot of prefix, then point the manifest of prefix to it
+        Readers keep seeing the previous snapshot until the manifest is written
+        :param prefix: string, path of the dataset inside the bucket, e.g. '/cleaned-data/train/'
+        :param files: dict, name of the file in the snapshot to local path
+        :return: string, ID of the snapshot
+        """
+        snapshot_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) + '-' + uuid.uuid4().hex[:8]
+        manifest = {'latest': snapshot_id, 'created': time.time(), 'files': {}}
+        for name, local_path in files.items():
+            path = f"{prefix.rstrip('/')}/{snapshot_id}/{name}"
+            self.upload(local_path, path)
+            manifest['files'][name] = path
+        self.write_json(manifest, f"{prefix.rstrip('/')}/{MANIFEST_NAME}")
+        logger.info(f"Published snapshot {snapshot_id} of {self.url(prefix)}")
+        return snapshot_id
+
+    def latest(self, prefix, name=None):
+        """
+        Resolve the latest file of a dataset by its manifest, or by modification time for datasets without manifest
+        :param prefix: string, path of the dataset inside the bucket
+        :param name: string, name of the file in the snapshot, the first one if None
+        :return: string, path of the file inside the bucket
+        :raise FileNotFoundError: if the dataset has no file, or its manifest does not list name
+        """
+        manifest_path = f"{prefix.rstrip('/')}/{MANIFEST_NAME}"
+        try:
+            manifest = self.read_json(manifest_path)
+        except FileNotFoundError:
+            manifest = None
+        if manifest is not None:
+            if name is None and manifest['files']:
+                return next(iter(manifest['files'].values()))
+            if name is not None and name in manifest['files']:
+                return manifest['files'][name]
+            raise FileNotFoundError(f"File [{name or 'any'}] not listed in the manifest {self.url(manifest_path)}")
+        self.fs.invalidate_cache(self.url(prefix))
+        # Entries without modification time, e.g. directories of some S3 implementations, cannot be ordered
+        files = [info for info in self._retry(self.fs.ls, self.url(prefix), detail=True)
+                 if info['type'] == 'file' and info.get('LastModified') is not None
+                 and (name is None or os.path.basename(info['name']) == name)]
+        if not files:
+            raise FileNotFoundError(f"No file found in {self.url(prefix)}")
+        latest_file = max(files, key=lambda info: info['LastModified'])
+        logger.warning(f"No manifest in {self.url(prefix)}, using the last modified file: {latest_file['name']}")
+        return latest_file['name'][len(self.bucket):]
+
+    def log_stats(self):
+        counters = self.counters
+        logger.info(f"S3 - downloaded {counters['bytes_downloaded'] / 2 ** 20:.1f}MiB in {counters['download_time']:.1f}s"
+                    f" - uploaded {counters['bytes_uploaded'] / 2 ** 20:.1f}MiB in {counters['upload_time']:.1f}s"
+                    f" - cache hits: {counters['cache_hits']} - cache misses: {counters['cache_misses']}"
+                    f" - retries: {counters['retries']}")
@@ -2,9 +2,11 @@
 import os
 import argparse
 import logging
-import s3fs
+import tempfile
 import pandas as pd
 
+from s3_io import S3Store
+
 ## Define logging behavior
 logging.getLogger("tokenizers").setLevel(logging.CRITICAL)
 logging.getLogger("transformers").setLevel(logging.CRITICAL)
@@ -20,6 +22,9 @@ parser.add_argument("--s3bucket_test_csv", help="S3 path where saved csv for tes
 parser.add_argument("--s3key", help="s3key", required=False, default=os.environ['AWS_ACCESS_KEY_ID'])
 parser.add_argument("--s3secret", help="s3secret", required=False, default=os.environ['AWS_SECRET_ACCESS_KEY'])
 parser.add_argument("--s3bucket", help="s3bucket", required=False, default=os.environ['AWS_BUCKET'])
+parser.add_argument("--s3endpoint", help="URL of an S3 compatible endpoint (MinIO, moto), AWS by default", required=False,
+                    default=os.environ.get('AWS_ENDPOINT_URL'))
+parser.add_argument("--s3cache_dir", help="Local directory caching downloaded S3 objects", required=False, default=None)
 
 preprocess_params = vars(parser.parse_args())  # args to dict
 
@@ -30,39 +35,35 @@ s3bucket = preprocess_params['s3bucket']
 s3bucket_train_csv = preprocess_params['s3bucket_train_csv']
 s3bucket_test_csv = preprocess_params['s3bucket_test_csv']
 
-# Connection using s3fs
-fs = s3fs.S3FileSystem(key=s3key, secret=s3secret)
-bucket_name = s3bucket
+# Connection to the datalake
+store = S3Store(s3bucket, key=s3key, secret=s3secret, endpoint_url=preprocess_params['s3endpoint'],
+                cache_dir=preprocess_params['s3cache_dir'])
 
 # If preprocessed data already exists, skip the preprocessing
 try:
-    train_csv = fs.ls(bucket_name + s3bucket_train_csv)[-1]
-    test_csv = fs.ls(bucket_name + s3bucket_test_csv)[-1]
-    with fs.open('s3://' + train_csv) as f:
-        train_init_df = pd.read_csv(f, sep='^([^,]+),', engine='python', usecols=['label', 'text'])
-    with fs.open('s3://' + test_csv) as f:
-        test_df = pd.read_csv(f, sep='^([^,]+),', engine='python', usecols=['label', 'text'])
+    train_csv = store.latest(s3bucket_train_csv, 'train.csv')
+    test_csv = store.latest(s3bucket_test_csv, 'test.csv')
+    train_init_df = pd.read_csv(store.download(train_csv), sep='^([^,]+),', engine='python', usecols=['label', 'text'])
+    test_df = pd.read_csv(store.download(test_csv), sep='^([^,]+),', engine='python', usecols=['label', 'text'])
     print('Preprocessed data already exists, Skipping step1.data_preparation & step2.preprocessing')
 
 except:
     # Read & Write
     def read_data():
-        with fs.open('s3://' + bucket_name + "/train.csv") as f:
-            train_df = pd.read_csv(f, sep='\t', engine='python')
-        with fs.open('s3://' + bucket_name + "/test.csv") as f:
-            test_df = pd.read_csv(f, sep='\t', engine='python')
+        train_df = pd.read_csv(store.download("/train.csv"), sep='\t', engine='python')
+        test_df = pd.read_csv(store.download("/test.csv"), sep='\t', engine='python')
         return train_df, test_df
 
 
     def write_data(train_df, test_df):
-        path_train = 's3://' + bucket_name + s3bucket_train_csv + "train.csv"
-        path_test = 's3://' + bucket_name + s3bucket_test_csv + "test.csv"
-        print(path_train)
-        with fs.open(path_train, 'w') as f:
-            train_df.to_csv(f, sep=',', index=False)
-        print(path_test)
-        with fs.open(path_test, 'w') as f:
-            test_df.to_csv(f, sep=',', index=False)
+        # Each dataset is published as a new snapshot, readers resolve it through the manifest
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            train_df.to_csv(os.path.join(tmp_dir, "train.csv"), sep=',', index=False)
+            test_df.to_csv(os.path.join(tmp_dir, "test.csv"), sep=',', index=False)
+            print(store.url(s3bucket_train_csv))
+            store.publish_snapshot(s3bucket_train_csv, {"train.csv": os.path.join(tmp_dir, "train.csv")})
+            print(store.url(s3bucket_test_csv))
+            store.publish_snapshot(s3bucket_test_csv, {"test.csv": os.path.join(tmp_dir, "test.csv")})
 
 
     ## Cleansing
@@ -75,3 +76,5 @@ except:
 
     print(train_df.head())
     print(test_df.head())
+
+store.log_stats()
@@ -1,9 +1,14 @@
 import os
 import argparse
-import s3fs
+import logging
+import tempfile
 import pandas as pd
 from datasets import load_dataset
 
+from s3_io import S3Store
+
+logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
+
 
 #%%
 ## Arguments
@@ -14,6 +19,8 @@ parser.add_argument("--s3secret", help="s3secret", required=False, default=os.en
 parser.add_argument("--s3bucket", help="s3bucket", required=False, default=os.environ['AWS_BUCKET'])
 parser.add_argument("--s3bucket_train_csv", help="S3 path where saved csv for training", default = '/cleaned-data/train/', required = False)
 parser.add_argument("--s3bucket_test_csv", help="S3 path where saved csv for testing", default = '/cleaned-data/test/', required = False)
+parser.add_argument("--s3endpoint", help="URL of an S3 compatible endpoint (MinIO, moto), AWS by default", required=False, default=os.environ.get('AWS_ENDPOINT_URL'))
+parser.add_argument("--s3cache_dir", help="Local directory caching downloaded S3 objects", required=False, default=None)
 # parser.add_argument("--mlflask_url", help="URL of the mlflow server", default=os.environ['MLFLASK_URL'],)
 # parser.add_argument("--mlflowserver_url", help="URL of the mlflow server", default=os.environ['MLFLOWSERVER_URL'],)
 
@@ -25,21 +32,19 @@ dataset_name = args.dataset
 
 
 #%%
-## Data loading and exporting to s3fs
-## Connection using s3fs
-fs = s3fs.S3FileSystem(key=s3key, secret=s3secret)
+## Data loading and exporting to S3
+## Connection to the datalake
+store = S3Store(s3bucket, key=s3key, secret=s3secret, endpoint_url=args.s3endpoint, cache_dir=args.s3cache_dir)
 bucket_name = s3bucket
 
 ## If preprocessed data already exists, skip the preprocessing
 try:
     s3bucket_train_csv = args.s3bucket_train_csv
     s3bucket_test_csv = args.s3bucket_test_csv
-    train_csv = fs.ls(bucket_name + s3bucket_train_csv)[-1]
-    test_csv = fs.ls(bucket_name + s3bucket_test_csv)[-1]
-    with fs.open('s3://' + train_csv) as f:
-        train_init_df = pd.read_csv(f, sep='^([^,]+),', engine='python', usecols=['label', 'text'])
-    with fs.open('s3://' + test_csv) as f:    
-        test_df = pd.read_csv(f, sep='^([^,]+),', engine='python', usecols=['label', 'text'])
+    train_csv = store.latest(s3bucket_train_csv, 'train.csv')
+    test_csv = store.latest(s3bucket_test_csv, 'test.csv')
+    train_init_df = pd.read_csv(store.download(train_csv), sep='^([^,]+),', engine='python', usecols=['label', 'text'])
+    test_df = pd.read_csv(store.download(test_csv), sep='^([^,]+),', engine='python', usecols=['label', 'text'])
     print('Preprocessed data already exists, Skipping step1.data_preparation & step2.preprocessing')
     
 except:
@@ -52,25 +57,26 @@ except:
     print('Data converted to dataframes')
     
     ## Export in CSV to the datalake (S3)
-    with fs.open('s3://' + bucket_name + "/train.csv", 'w') as f:
-        train_df.to_csv(f, index=False, sep="\t")
-    with fs.open('s3://' + bucket_name + "/test.csv", 'w') as f:
-        test_df.to_csv(f, index=False, sep="\t")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        train_df.to_csv(os.path.join(tmp_dir, "train.csv"), index=False, sep="\t")
+        test_df.to_csv(os.path.join(tmp_dir, "test.csv"), index=False, sep="\t")
+        store.upload(os.path.join(tmp_dir, "train.csv"), "/train.csv")
+        store.upload(os.path.join(tmp_dir, "test.csv"), "/test.csv")
     print('Data exported to S3')
     
     ## Verify files in the bucket
-    files = fs.ls(bucket_name)
+    files = store.fs.ls(bucket_name)
     print('Connected to S3 bucket:', bucket_name)
     print('Listing files:', files)
     
     ## Show examples of csvs saved in the bucket
-    with fs.open('s3://' + bucket_name + "/train.csv") as f:
-        train_df = pd.read_csv(f, sep="\t")
+    train_df = pd.read_csv(store.download("/train.csv"), sep="\t")
     print("Example of Train df")
     print(train_df.head())
     print("length:", len(train_df))
-    with fs.open('s3://' + bucket_name + "/test.csv") as f:
-        test_df = pd.read_csv(f, sep="\t")
+    test_df = pd.read_csv(store.download("/test.csv"), sep="\t")
     print("Example of Test df")
     print(test_df.head())
     print("length:", len(test_df))
+
+store.log_stats()
@@ -1,17 +1,19 @@
 #%%
 ## Import librairies
+## pandas, torch and transformers are imported only when needed to keep the startup fast
+import time
+startup_time = time.time()
 import os
 import argparse
+import ast
 import logging
-import json
-import requests
 
 import numpy as np
-import pandas as pd
-import torch
 
-from datasets import Dataset
-from transformers import AutoTokenizer #,AutoModelForSequenceClassification
+from bulk_io import FORMATS, ChunkWriter, read_chunks
+from http_client import InferenceClient
+from prediction_cache import PredictionCache, normalize_text
+from wire_format import parse_predictions
 
 
 #%%
@@ -26,82 +28,202 @@ logger = logging.getLogger(__name__)
 ## Manage job parameters
 parser = argparse.ArgumentParser()
 ## Required for model handler demo
-parser.add_argument("--server_url", help="URL of the mlflow server", required=False, default=os.environ['MLFLASK_URL']+"/predict")
+parser.add_argument("--server_url", help="URL of the mlflow server", required=False, default=os.environ.get('MLFLASK_URL', '')+"/predict")
 parser.add_argument("--model_name", help="Name of the model to call", required=False, default='CommentCLF1')
 parser.add_argument("--input_texts", help="The texts for inference test, e.g. ['sentence1', 'sentence2', 'sentence3', 'sentence4']"
                     , default = "['Very good movie!', 'Not really enjoyable, not interesting at all, to be honest it has nothing', 'I was looking forward to this movie. Trustworthy actors', 'What a nasty cynical film. Apparently this sad excuse for a dramatic urban look at what 20 year olds do whilst crawling through the gutter of Sydney nightlife is supposed to be somehow connecting with its target market.']"
-                    , required = True)
+                    , required = False)
+## Backend running the model, the model server over HTTP or in-process
+parser.add_argument("--backend", help="Where the model runs, 'http' (model server at --server_url) or 'local' (in-process, loaded from --model_uri)", choices=['http', 'local'], default = 'http', required = False)
+parser.add_argument("--model_uri", help="mlflow URI of the pytorch model for the local backend, e.g. 'models:/model_imdb/1'", default = None, required = False)
+parser.add_argument("--mlflowserver_url", help="URL of the mlflow server or local file store for the local backend", default = os.environ.get('MLFLOWSERVER_URL'), required = False)
+parser.add_argument("--num_threads", help="Number of torch threads for the local backend. If 0 (default), torch default", type=int, default = 0, required = False)
+parser.add_argument("--quantize", help="Dynamically quantize the model to int8 in the local backend", action="store_true")
+## Prediction cache, only texts missing from the cache are tokenized and sent
+parser.add_argument("--cache", help="Cache predictions in memory, keyed by model name, version and normalized text", action="store_true")
+parser.add_argument("--cache_size", help="Maximum number of predictions kept in memory", type=int, default = 10000, required = False)
+parser.add_argument("--cache_path", help="Path of a SQLite database caching predictions on disk, enables the cache", default = None, required = False)
+parser.add_argument("--cache_max_entries", help="Maximum number of predictions kept on disk, least recently used are evicted", type=int, default = 1000000, required = False)
+parser.add_argument("--cache_ttl_hours", help="Lifetime of the predictions cached on disk in hours. If 0 (default), no expiration", type=float, default = 0, required = False)
+parser.add_argument("--model_version", help="Version of the model, part of the cache keys. Required with --cache_path and the http backend. Defaults to the version resolved from --model_uri for the local backend", default = None, required = False)
+## Bulk mode, used instead of --input_texts when --input_file is given
+parser.add_argument("--input_file", help="Local path or s3:// URL of a CSV, JSONL or Parquet file to predict, streamed by chunks", default = None, required = False)
+parser.add_argument("--output_file", help="Local path or s3:// URL of the CSV, JSONL or Parquet file where the input rows and their predictions are written", default = None, required = False)
+parser.add_argument("--input_format", help="Format of the input file, inferred from the extension by default", choices=FORMATS, default = None, required = False)
+parser.add_argument("--output_format", help="Format of the output file, inferred from the extension by default", choices=FORMATS, default = None, required = False)
+parser.add_argument("--text_column", help="Column of the input file containing the texts", default = 'text', required = False)
+parser.add_argument("--chunk_size", help="Number of rows read, predicted and written at a time in bulk mode", type=int, default = 1000, required = False)
+parser.add_argument("--s3key", help="s3key", required=False, default=os.environ.get('AWS_ACCESS_KEY_ID'))
+parser.add_argument("--s3secret", help="s3secret", required=False, default=os.environ.get('AWS_SECRET_ACCESS_KEY'))
 ## Permanent params of handler
 parser.add_argument("--test_batchsize", help="Batch size for the test and val datasets", type=int, default = 4, required = False)
 parser.add_argument("--tokenizer_name", help="name of the pretrained model to load from huggingface repository", default = 'prajjwal1/bert-tiny', required = False)
 parser.add_argument("--device", help="Device where is computed Deep learning, 'cpu' or 'cuda'", default = 'cpu', required = False)
+parser.add_argument("--max_concurrent_requests", help="Maximum number of batches sent concurrently to the server", type=int, default = 4, required = False)
+parser.add_argument("--request_timeout", help="Timeout of a request to the server in seconds", type=float, default = 30, required = False)
+parser.add_argument("--wire_format", help="Payload format sent to the server, 'json' or 'binary' (raw little-endian arrays, falls back to json if the server answers 400, 415, 422 or 5xx to the first binary request)", choices=['json', 'binary'], default = 'json', required = False)
+parser.add_argument("--request_retries", help="Number of retries of a request on connection error or 429/5xx response", type=int, default = 3, required = False)
 
 inference_params = vars(parser.parse_args()) # args to dict
 
 model_name = inference_params['model_name']
-input_texts = inference_params['input_texts']
-exec('input_texts='+input_texts)
-print('Input Texts: '+str(input_texts))
+if inference_params['backend'] == 'local' and not inference_params['model_uri']:
+    parser.error("--model_uri is required with --backend local")
+if inference_params['backend'] == 'http' and inference_params['cache_path'] and not inference_params['model_version']:
+    # The served model is redeployed under the same name, its predictions must not outlive it on disk
+    parser.error("--model_version is required with --cache_path and --backend http")
+if inference_params['input_file'] and not inference_params['output_file']:
+    parser.error("--output_file is required with --input_file")
+if not inference_params['input_file']:
+    # Parse the list literal without executing it
+    input_texts = ast.literal_eval(inference_params['input_texts'])
+    print('Input Texts: '+str(input_texts))
 
 ## Class dict
 classdict = {0: 'Negative', 1: 'Positive'}
 
 
 #%% Load Tokenizer from Hunggingface 
-### Define the device to use by torch
-device = torch.device(inference_params['device'])
-### Prepare tokenizer
-tokenizer = AutoTokenizer.from_pretrained(inference_params['tokenizer_name'])
-def tokenization(example, tokenizer=tokenizer):
-    return tokenizer(example["text"], truncation = True, padding = True, max_length = 500)
+tokenizer = None
+def get_tokenizer():
+    """Load the fast tokenizer on first use, it is not needed when every prediction is cached"""
+    global tokenizer
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(inference_params['tokenizer_name'], use_fast=True)
+    return tokenizer
 
 
 #%% Inference Data Preprocessing
-### Load train and test datasets, and make val dataset
-test_df = pd.DataFrame(input_texts, columns=['text'])
-### Convert to Dataset type
-test_ds = Dataset.from_pandas(test_df)
-### Apply tokenizer on datasets
-test_ds = test_ds.map(tokenization, batched=True)
-### Create DataLoaders
-test_ds.set_format(type='torch', columns=['input_ids', 'attention_mask'])
-test_loader = torch.utils.data.DataLoader(test_ds, batch_size=inference_params['test_batchsize'], shuffle = False)
+def tokenize_batches(texts):
+    """Tokenize texts by batches of test_batchsize directly into numpy arrays, each batch padded to its longest text"""
+    batch_size = inference_params['test_batchsize']
+    # Token IDs fit in int32 and the attention mask in uint8 for the binary wire format
+    dtypes = ('<i4', '<u1') if inference_params['wire_format'] == 'binary' else (np.int64, np.int64)
+    batches = []
+    for start in range(0, len(texts), batch_size):
+        encoding = get_tokenizer()(texts[start:start + batch_size], truncation = True, padding = True, max_length = 500, return_tensors = 'np')
+        batches.append([encoding['input_ids'].astype(dtypes[0]), encoding['attention_mask'].astype(dtypes[1])])
+    return batches
 
 
 #%% Inference Handling
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return json.JSONEncoder.default(self, obj)
-
-
-def post(data, model:str, serve_url=inference_params['server_url'], data_type='json'):
+def resolve_model_uri(model_uri):
+    """
+    Resolve a registry URI pointing to a stage or to the latest version, e.g. 'models:/model_imdb/Production',
+    into the URI of a concrete version, so that the cache keys and the loaded model match
+    :param model_uri: string, mlflow URI of the model
+    :return: tuple, URI of the concrete version and version used in the cache keys
+    """
+    if not model_uri.startswith('models:/'):
+        # runs:/ and file URIs always point to the same model
+        return model_uri, model_uri
+    registered_name, reference = model_uri[len('models:/'):].strip('/').split('/', 1)
+    if reference.isdigit():
+        return model_uri, f'{registered_name}/{reference}'
+    from mlflow.tracking import MlflowClient
+    stages = None if reference.lower() == 'latest' else [reference]
+    versions = MlflowClient(inference_params['mlflowserver_url']).get_latest_versions(registered_name, stages)
+    if not versions:
+        raise ValueError(f"No version of the model found for [{model_uri}]")
+    version = max(int(model_version.version) for model_version in versions)
+    logger.info(f"{model_uri} resolved to version {version}")
+    return f'models:/{registered_name}/{version}', f'{registered_name}/{version}'
+
+
+if inference_params['backend'] == 'local':
+    from local_backend import LocalBackend
+    model_uri, resolved_version = resolve_model_uri(inference_params['model_uri'])
+    # Same interface as the HTTP client, so predictions go through the same code
+    client = LocalBackend(model_uri,
+                          tracking_uri=inference_params['mlflowserver_url'],
+                          device=inference_params['device'],
+                          num_threads=inference_params['num_threads'],
+                          quantize=inference_params['quantize'])
+else:
+    client = InferenceClient(inference_params['server_url'],
+                             max_workers=inference_params['max_concurrent_requests'],
+                             timeout=inference_params['request_timeout'],
+                             max_retries=inference_params['request_retries'],
+                             data_type=inference_params['wire_format'])
+
+
+def post(data, model:str):
     """Inference with POST requests """
-    if data_type == 'json':
-        headers = {'Content-Type': 'application/json'}
-    model_input = json.dumps({"data":data, "model":model}, cls=NumpyEncoder)
-    response = requests.post(serve_url, headers=headers, data=model_input, verify=False)
-    response = response._content.decode('utf-8')
-    try:
-        response = json.loads(response)
-        return response
-    except:
-        return response
-
-
-def predict(test_loader, model):
-    with torch.no_grad():
-        all_preds = []
-        for batch in test_loader:            
-            data = [batch['input_ids'].numpy(), batch['attention_mask'].numpy()]
-            preds = post(data, model)['response'] # like "[1 0 1 0]"
-            preds = np.array(preds[1:-1].split()).astype(int) # like array([1., 0., 1., 0.])
-            # print(preds) ## Debug use
-            # print(type(preds)) ## Debug use
-            all_preds.append(preds)
-        all_preds = np.vstack(all_preds)
-        # all_preds = np.argmax(all_preds, axis=1)
-    return np.vectorize(classdict.get)(all_preds)
-
-print('prediction: '+str(predict(test_loader, model_name)))
\ No newline at end of file
+    return client.post(data, model)
+
+
+def predict_ids(texts, model):
+    if not texts:
+        return np.array([], dtype=int)
+    batches = tokenize_batches(texts)
+    # Batches are sent concurrently, responses come back in the same order
+    all_preds = []
+    for response in client.post_many(batches, model):
+        # like "[1 0 1 0]" in json, or already array([1, 0, 1, 0]) in binary and local backend
+        all_preds.append(parse_predictions(response['response']))
+    return np.hstack(all_preds)
+
+
+def predict(texts, model):
+    return np.vectorize(classdict.get, otypes=[object])(predict_ids(texts, model))
+
+
+cache = None
+if inference_params['cache'] or inference_params['cache_path']:
+    # Without --model_version the http backend only caches in memory, for the lifetime of the job
+    model_version = inference_params['model_version'] or (resolved_version if inference_params['backend'] == 'local' else 'latest')
+    cache = PredictionCache(model_name, model_version,
+                            max_memory_entries=inference_params['cache_size'],
+                            disk_path=inference_params['cache_path'],
+                            max_disk_entries=inference_params['cache_max_entries'],
+                            ttl_seconds=inference_params['cache_ttl_hours'] * 3600)
+
+
+def predict_texts(texts, model):
+    """Predict texts, only the ones missing from the cache are tokenized and sent"""
+    if cache is None:
+        return predict(texts, model)
+    preds = cache.get_many(texts)
+    # Texts sharing the same normalized form are predicted once
+    missing_texts = list({normalize_text(texts[i]): texts[i] for i, pred in enumerate(preds) if pred is None}.values())
+    if missing_texts:
+        missing_preds = predict_ids(missing_texts, model)
+        cache.put_many(missing_texts, missing_preds)
+        new_preds = {normalize_text(text): pred for text, pred in zip(missing_texts, missing_preds)}
+        preds = [pred if pred is not None else new_preds[normalize_text(text)] for text, pred in zip(texts, preds)]
+    return np.vectorize(classdict.get, otypes=[object])(np.array(preds, dtype=int))
+
+
+def predict_file(input_file, output_file, model):
+    """Stream the input file by chunks, predict each chunk and append it to the output file"""
+    fs = None
+    if input_file.startswith('s3://') or output_file.startswith('s3://'):
+        import s3fs
+        fs = s3fs.S3FileSystem(key=inference_params['s3key'], secret=inference_params['s3secret'])
+    text_column = inference_params['text_column']
+    since = time.time()
+    with ChunkWriter(output_file, inference_params['output_format'], fs) as writer:
+        for chunk in read_chunks(input_file, text_column, inference_params['chunk_size'], inference_params['input_format'], fs):
+            if len(chunk) == 0:
+                continue
+            texts = chunk[text_column].fillna('').astype(str).tolist()
+            writer.write(chunk.assign(prediction=predict_texts(texts, model)))
+            elapsed = time.time() - since
+            logger.info(f'{writer.nb_rows} rows predicted - {writer.nb_rows / elapsed:.1f} rows/s')
+    logger.info(f'Predictions written to {output_file}: {writer.nb_rows} rows in {time.time() - since:.0f}s')
+
+
+logger.info(f'Startup time: {1000 * (time.time() - startup_time):.0f}ms')
+with client:
+    if inference_params['input_file']:
+        predict_file(inference_params['input_file'], inference_params['output_file'], model_name)
+    else:
+        since = time.time()
+        print('prediction: '+str(predict_texts(input_texts, model_name)))
+        logger.info(f"{inference_params['backend']} backend: {len(input_texts)} texts predicted in {1000 * (time.time() - since):.0f}ms")
+
+if cache is not None:
+    stats = cache.stats()
+    logger.info(f"Prediction cache - hit rate: {stats['hit_rate']:.1%} - memory hits: {stats['memory_hits']} - disk hits: {stats['disk_hits']} - misses: {stats['misses']}")
+    cache.close()
@@ -0,0 +1,141 @@
+import os
+
+FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+def infer_format(path, file_format=None):
+    """
+    Find the format of a file from its extension if not given
+    :param path: string, local path or s3:// URL
+    :param file_format: string, format forced by the user, among FORMATS
+    :return: string, format among FORMATS
+    """
+    if file_format:
+        return file_format
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    if extension in ('json', 'ndjson'):
+        extension = 'jsonl'
+    if extension not in FORMATS:
+        raise ValueError(f"Cannot infer the format of [{path}], use one of {FORMATS}")
+    return extension
+
+
+def open_file(path, mode='rb', fs=None):
+    """
+    Open a local file or an S3 object
+    :param path: string, local path or s3:// URL
+    :param mode: string, opening mode
+    :param fs: s3fs.S3FileSystem, filesystem used for s3:// URLs
+    :return: file object
+    """
+    if path.startswith('s3://'):
+        if fs is None:
+            raise ValueError(f"An S3 filesystem is required to open [{path}]")
+        return fs.open(path, mode)
+    return open(path, mode)
+
+
+def read_chunks(path, text_column='text', chunk_size=1000, file_format=None, fs=None):
+    """
+    Stream a CSV, JSONL or Parquet file by chunks, only one chunk is in memory at a time
+    :param path: string, local path or s3:// URL
+    :param text_column: string, column containing the texts, other columns are kept
+    :param chunk_size: int, number of rows of each chunk
+    :param file_format: string, format among FORMATS, inferred from the extension if None
+    :param fs: s3fs.S3FileSystem, filesystem used for s3:// URLs
+    :return: generator of pandas.DataFrame
+    """
+    import pandas as pd
+
+    file_format = infer_format(path, file_format)
+    with open_file(path, 'rb', fs) as f:
+        if file_format == 'csv':
+            readers = pd.read_csv(f, chunksize=chunk_size)
+        elif file_format == 'jsonl':
+            readers = pd.read_json(f, lines=True, chunksize=chunk_size)
+        else:
+            import pyarrow.parquet as pq
+            readers = (batch.to_pandas() for batch in pq.ParquetFile(f).iter_batches(batch_size=chunk_size))
+        for chunk in readers:
+            if text_column not in chunk.columns:
+                raise ValueError(f"Column [{text_column}] not found in [{path}]")
+            yield chunk
+
+
+class ChunkWriter(object):
+    """Append DataFrame chunks to a CSV, JSONL or Parquet file"""
+    def __init__(self, path, file_format=None, fs=None):
+        """
+        :param path: string, local path or s3:// URL
+        :param file_format: string, format among FORMATS, inferred from the extension if None
+        :param fs: s3fs.S3FileSystem, filesystem used for s3:// URLs
+        """
+        self.path = path
+        self.file_format = infer_format(path, file_format)
+        self.nb_rows = 0
+        self._file = open_file(path, 'wb', fs)
+        self._parquet_writer = None
+        self._parquet_schema = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write(self, chunk):
+        if self.file_format == 'csv':
+            self._file.write(chunk.to_csv(index=False, header=self.nb_rows == 0).encode('utf-8'))
+        elif self.file_format == 'jsonl':
+            self._file.write(chunk.to_json(orient='records', lines=True).rstrip('\n').encode('utf-8') + b'\n')
+        else:
+            import pyarrow.parquet as pq
+            table = self._to_table(chunk)
+            if self._parquet_writer is None:
+                self._parquet_schema = table.schema
+                self._parquet_writer = pq.ParquetWriter(self._file, table.schema)
+            self._parquet_writer.write_table(table)
+        self.nb_rows += len(chunk)
+
+    def _to_table(self, chunk):
+        """
+        Convert a chunk to an arrow table with the schema of the parquet file, fixed by the first chunk
+        Types inferred by pandas may change from a chunk to another (all-null columns, ints with missing values),
+        so columns are cast to the schema of the file
+        :param chunk: pandas.DataFrame, chunk to convert
+        :return: pyarrow.Table, table with the schema of the file
+        :raise ValueError: if a chunk cannot be stored with the schema of the file
+        """
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self._parquet_schema is None:
+            # The type of a column without any value in the first chunk is unknown (pandas reads it as float NaN),
+            # store it as string
+            fields = [pa.field(field.name, pa.string()) if table.column(field.name).null_count == len(table) else field
+                      for field in table.schema]
+            return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+        schema = self._parquet_schema
+        new_columns = [name for name in table.column_names if schema.get_field_index(name) == -1]
+        if new_columns:
+            raise ValueError(f"Columns {new_columns} of rows {self.nb_rows}+ are missing from the first chunk, "
+                             f"they cannot be added to the parquet file [{self.path}], use a csv or jsonl output "
+                             f"or a bigger chunk size")
+        columns = []
+        for field in schema:
+            if field.name not in table.column_names:
+                columns.append(pa.nulls(len(table), field.type))
+                continue
+            try:
+                columns.append(table.column(field.name).cast(field.type))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise ValueError(f"Column [{field.name}] of rows {self.nb_rows}+ cannot be written as {field.type} "
+                                 f"like the first chunk in the parquet file [{self.path}]: {e}") from e
+        return pa.Table.from_arrays(columns, schema=schema)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        self._file.close()
@@ -0,0 +1,195 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from wire_format import BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, decode_arrays, encode_arrays
+
+logger = logging.getLogger(__name__)
+
+# Statuses of a server that does not understand binary payloads, a json-only endpoint may also answer 5xx
+UNSUPPORTED_PAYLOAD_STATUSES = (400, 415, 422)
+
+
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return json.JSONEncoder.default(self, obj)
+
+
+class InferenceClient(object):
+    """Keep-alive HTTP client sending inference batches concurrently with a bounded number of in-flight requests"""
+    def __init__(self, serve_url, max_workers=4, timeout=30.0, max_retries=3, backoff_factor=0.5, verify=False,
+                 data_type='json'):
+        """
+        :param serve_url: string, URL of the predict endpoint
+        :param max_workers: int, maximum number of requests in flight
+        :param timeout: float, timeout of a request in seconds
+        :param max_retries: int, number of retries on connection errors and 429/5xx responses
+        :param backoff_factor: float, backoff factor between retries in seconds
+        :param verify: bool, whether to verify the server TLS certificate
+        :param data_type: string, default payload format, 'json' or 'binary'
+        """
+        self.serve_url = serve_url
+        self.data_type = data_type
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.verify = verify
+        retries = Retry(total=max_retries, backoff_factor=backoff_factor,
+                        status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(['POST']))
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=max_workers, max_retries=retries))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=max_workers, max_retries=retries))
+        # The first binary request probes the server, it is only retried on connection errors
+        probe_retries = Retry(total=max_retries, backoff_factor=backoff_factor, allowed_methods=frozenset(['POST']))
+        self._probe_session = requests.Session()
+        self._probe_session.mount('http://', HTTPAdapter(max_retries=probe_retries))
+        self._probe_session.mount('https://', HTTPAdapter(max_retries=probe_retries))
+        self._probe_lock = threading.Lock()
+        self._binary_supported = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.session.close()
+        self._probe_session.close()
+
+    def _send(self, session, data, model, data_type):
+        if data_type == 'binary':
+            headers = {'Content-Type': BINARY_CONTENT_TYPE, 'Accept': f'{BINARY_CONTENT_TYPE}, {JSON_CONTENT_TYPE}'}
+            model_input = encode_arrays(data, model=model)
+        else:
+            headers = {'Content-Type': JSON_CONTENT_TYPE}
+            model_input = json.dumps({"data": data, "model": model}, cls=NumpyEncoder)
+        return session.post(self.serve_url, headers=headers, data=model_input, timeout=self.timeout, verify=self.verify)
+
+    def _fall_back_to_json(self, status_code):
+        logger.warning(f"Server answered {status_code} to a binary payload, falling back to json")
+        self._binary_supported = False
+        self.data_type = 'json'
+
+    def post(self, data, model: str, data_type=None):
+        """Inference with POST requests """
+        data_type = data_type or self.data_type
+        if data_type == 'binary' and self._binary_supported is None:
+            with self._probe_lock:
+                if self._binary_supported is None:
+                    response = self._send(self._probe_session, data, model, 'binary')
+                    if response.status_code in UNSUPPORTED_PAYLOAD_STATUSES or response.status_code >= 500:
+                        self._fall_back_to_json(response.status_code)
+                    else:
+                        response.raise_for_status()
+                        self._binary_supported = True
+                        return self._parse(response)
+        if data_type == 'binary' and self._binary_supported is False:
+            data_type = 'json'
+        response = self._send(self.session, data, model, data_type)
+        if data_type == 'binary' and response.status_code == 415:
+            # The server stopped accepting binary payloads, e.g. after a redeployment
+            self._fall_back_to_json(response.status_code)
+            return self.post(data, model, 'json')
+        response.raise_for_status()
+        return self._parse(response)
+
+    def _parse(self, response):
+        if response.headers.get('Content-Type', '').startswith(BINARY_CONTENT_TYPE):
+            arrays, metadata = decode_arrays(response.content)
+            return dict(metadata, response=arrays[0])
+        response = response.content.decode('utf-8')
+        try:
+            return json.loads(response)
+        except ValueError:
+            return response
+
+    def post_many(self, batches, model: str, data_type=None):
+        """
+        Send batches concurrently
+        :param batches: list, data of each request
+        :param model: string, name of the model to call
+        :param data_type: string, payload format, 'json' or 'binary', client default if None
+        :return: list, responses in the same order as batches
+        """
+        if self.max_workers <= 1 or len(batches) <= 1:
+            return [self.post(data, model, data_type) for data in batches]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda data: self.post(data, model, data_type), batches))
+
+
+class _StubServer(ThreadingHTTPServer):
+    # Default listen backlog of 5 drops connections at high concurrency
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Predict endpoint answering like the model server after a fixed delay"""
+    delay = 0.01
+
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.delay)
+        if self.headers['Content-Type'] == BINARY_CONTENT_TYPE:
+            input_ids = decode_arrays(payload)[0][0]
+            content_type = BINARY_CONTENT_TYPE
+            body = encode_arrays([np.ones(len(input_ids), dtype='<i4')])
+        else:
+            input_ids = json.loads(payload)['data'][0]
+            content_type = JSON_CONTENT_TYPE
+            preds = ' '.join('1' for _ in input_ids)
+            body = json.dumps({"response": f"[{preds}]"}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark(concurrency_levels=(1, 2, 4, 8, 16), nb_batches=200, batch_size=4, seq_len=128, delay=0.01,
+              data_type='json'):
+    """
+    Report the throughput of InferenceClient against a local stub server at several concurrency levels
+    :return: dict, concurrency level to batches per second
+    """
+    _StubHandler.delay = delay
+    server = _StubServer(('127.0.0.1', 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    serve_url = f'http://127.0.0.1:{server.server_address[1]}/predict'
+    batch = [np.ones((batch_size, seq_len), dtype=np.int64), np.ones((batch_size, seq_len), dtype=np.int64)]
+    results = {}
+    try:
+        for max_workers in concurrency_levels:
+            with InferenceClient(serve_url, max_workers=max_workers, data_type=data_type) as client:
+                start = time.perf_counter()
+                client.post_many([batch] * nb_batches, 'stub')
+                elapsed = time.perf_counter() - start
+            results[max_workers] = nb_batches / elapsed
+            print(f'Concurrency {max_workers:>3}: {results[max_workers]:.1f} batches/s')
+    finally:
+        server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark InferenceClient against a local stub server')
+    parser.add_argument("--nb_batches", type=int, default=200, help="Number of batches sent at each concurrency level")
+    parser.add_argument("--delay", type=float, default=0.01, help="Latency of the stub server in seconds")
+    parser.add_argument("--wire_format", choices=['json', 'binary'], default='json', help="Payload format")
+    args = parser.parse_args()
+    benchmark(nb_batches=args.nb_batches, delay=args.delay, data_type=args.wire_format)
@@ -0,0 +1,65 @@
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# torch.inference_mode only exists from torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+class LocalBackend(object):
+    """Run a registered model in-process, with the same interface as InferenceClient"""
+    def __init__(self, model_uri, tracking_uri=None, device='cpu', num_threads=0, quantize=False):
+        """
+        :param model_uri: string, mlflow URI of the pytorch model, e.g. 'models:/model_imdb/1' or 'runs:/<run_id>/pytorch-model'
+        :param tracking_uri: string, URI of the mlflow server or local file store, mlflow default if None
+        :param device: string, device where the model runs, 'cpu' or 'cuda'
+        :param num_threads: int, number of threads used by torch on cpu, torch default if 0
+        :param quantize: bool, whether to dynamically quantize the linear layers to int8 (cpu only)
+        """
+        import mlflow.pytorch
+
+        if tracking_uri:
+            mlflow.set_tracking_uri(tracking_uri)
+            mlflow.set_registry_uri(tracking_uri)
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device(device)
+        logger.info(f"Loading model from {model_uri} ...")
+        model = mlflow.pytorch.load_model(model_uri, map_location=self.device)
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+            self.device = torch.device('cpu')
+        self.model = model.to(self.device).eval()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def post(self, data, model: str = None, data_type=None):
+        """
+        Predict a batch, answering like the model server
+        :param data: list, input_ids and attention_mask arrays
+        :param model: string, unused, the model is the one loaded from model_uri
+        :param data_type: string, unused
+        :return: dict, predicted classes under 'response'
+        """
+        input_ids, attention_mask = (torch.as_tensor(np.asarray(array, dtype=np.int64)).to(self.device) for array in data)
+        with inference_mode():
+            logits = self.model(input_ids, attention_mask=attention_mask)["logits"]
+        return {"response": np.argmax(logits.cpu().numpy(), axis=1)}
+
+    def post_many(self, batches, model: str = None, data_type=None):
+        """
+        Predict batches one after the other, torch already uses several threads for each forward pass
+        :return: list, responses in the same order as batches
+        """
+        return [self.post(data, model, data_type) for data in batches]
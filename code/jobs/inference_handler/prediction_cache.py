@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACES = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """
+    Normalize a text so that near-identical texts share the same cache entry
+    Unicode is NFKC normalized and whitespaces are collapsed, case is kept as the tokenizer may be cased
+    :param text: string, text to normalize
+    :return: string, normalized text
+    """
+    return _WHITESPACES.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+class PredictionCache(object):
+    """Cache of predictions with an in-memory LRU tier and an optional SQLite tier on disk"""
+    def __init__(self, model_name, model_version, max_memory_entries=10000, disk_path=None,
+                 max_disk_entries=1000000, ttl_seconds=0):
+        """
+        :param model_name: string, name of the model, part of every key
+        :param model_version: string, version of the model, part of every key
+        :param max_memory_entries: int, maximum number of entries of the in-memory tier
+        :param disk_path: string, path of the SQLite database of the disk tier, no disk tier if None
+        :param max_disk_entries: int, maximum number of entries of the disk tier, least recently used are evicted
+        :param ttl_seconds: float, lifetime of the disk entries in seconds, no expiration if 0
+        """
+        self.namespace = f'{model_name}:{model_version}:'
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions "
+                             "(key TEXT PRIMARY KEY, value INTEGER, created REAL, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS predictions_accessed ON predictions (accessed)")
+            self._expire()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def key(self, text):
+        return hashlib.sha256((self.namespace + normalize_text(text)).encode('utf-8')).hexdigest()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _expire(self):
+        if self.ttl_seconds > 0:
+            with self._db:
+                self._db.execute("DELETE FROM predictions WHERE created < ?", (time.time() - self.ttl_seconds,))
+
+    def get_many(self, texts):
+        """
+        Look texts up in memory, then on disk
+        :param texts: list, texts to look up
+        :return: list, cached prediction of each text, None for misses
+        """
+        keys = [self.key(text) for text in texts]
+        values = [None] * len(keys)
+        disk_lookups = {}
+        for i, key in enumerate(keys):
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                values[i] = self._memory[key]
+                self.memory_hits += 1
+            else:
+                disk_lookups.setdefault(key, []).append(i)
+
+        if self._db is not None and disk_lookups:
+            now = time.time()
+            min_created = now - self.ttl_seconds if self.ttl_seconds > 0 else 0
+            found = {}
+            lookup_keys = list(disk_lookups)
+            # Stay under the SQLite limit of variables per query
+            for start in range(0, len(lookup_keys), 500):
+                chunk = lookup_keys[start:start + 500]
+                rows = self._db.execute(f"SELECT key, value FROM predictions WHERE created >= ? AND key IN "
+                                        f"({','.join('?' * len(chunk))})", [min_created] + chunk)
+                found.update(rows.fetchall())
+            with self._db:
+                self._db.executemany("UPDATE predictions SET accessed = ? WHERE key = ?",
+                                     [(now, key) for key in found])
+            for key, value in found.items():
+                self._remember(key, value)
+                for i in disk_lookups.pop(key):
+                    values[i] = value
+                    self.disk_hits += 1
+
+        self.misses += sum(len(indices) for indices in disk_lookups.values())
+        return values
+
+    def put_many(self, texts, values):
+        """
+        Store predictions of texts in every tier
+        :param texts: list, texts
+        :param values: list, prediction of each text
+        """
+        now = time.time()
+        entries = [(self.key(text), int(value)) for text, value in zip(texts, values)]
+        for key, value in entries:
+            self._remember(key, value)
+        if self._db is not None:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                                     [(key, value, now, now) for key, value in entries])
+                nb_extra = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.max_disk_entries
+                if nb_extra > 0:
+                    self._db.execute("DELETE FROM predictions WHERE key IN "
+                                     "(SELECT key FROM predictions ORDER BY accessed LIMIT ?)", (nb_extra,))
+
+    @property
+    def hit_rate(self):
+        nb_lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / nb_lookups if nb_lookups else 0.0
+
+    def stats(self):
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,96 @@
+import argparse
+import json
+import struct
+import time
+
+import numpy as np
+
+# Content type of the binary payload: a small header followed by raw little-endian arrays
+BINARY_CONTENT_TYPE = 'application/x-ndarray'
+JSON_CONTENT_TYPE = 'application/json'
+
+MAGIC = b'NDA1'
+# Magic, then length of the json metadata
+_HEADER = struct.Struct('<4sI')
+
+
+def encode_arrays(arrays, **metadata):
+    """
+    Encode arrays into the binary wire format
+    Layout: MAGIC | uint32 metadata length | json metadata | raw little-endian data of each array
+    :param arrays: list, numpy arrays to encode
+    :param metadata: extra json serializable values stored in the header, e.g. model name
+    :return: bytes, encoded payload
+    """
+    arrays = [np.ascontiguousarray(array, dtype=np.asarray(array).dtype.newbyteorder('<')) for array in arrays]
+    metadata = dict(metadata, arrays=[{'dtype': array.dtype.str, 'shape': list(array.shape)} for array in arrays])
+    meta = json.dumps(metadata).encode('utf-8')
+    return b''.join([_HEADER.pack(MAGIC, len(meta)), meta] + [array.tobytes() for array in arrays])
+
+
+def decode_arrays(payload):
+    """
+    Decode a payload of the binary wire format
+    :param payload: bytes, encoded payload
+    :return: tuple, list of numpy arrays and dict of extra metadata
+    """
+    magic, meta_len = _HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("Payload is not in the binary ndarray wire format")
+    offset = _HEADER.size
+    metadata = json.loads(payload[offset:offset + meta_len].decode('utf-8'))
+    offset += meta_len
+    arrays = []
+    for info in metadata.pop('arrays'):
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape'], dtype=np.int64))
+        arrays.append(np.frombuffer(payload, dtype=dtype, count=count, offset=offset).reshape(info['shape']))
+        offset += count * dtype.itemsize
+    return arrays, metadata
+
+
+def parse_predictions(response):
+    """
+    Convert a prediction response of the server into a numeric array
+    :param response: string like "[1 0 1 0]", list or numpy array
+    :return: numpy array of int
+    """
+    if isinstance(response, str):
+        return np.array(response.strip()[1:-1].replace(',', ' ').split()).astype(int)
+    return np.asarray(response).astype(int)
+
+
+def benchmark(batch_size=4, seq_len=500, nb_repeats=200, vocab_size=30522):
+    """
+    Compare payload size and encode/decode time of json and binary wire formats for a batch of token IDs
+    :return: dict, format to size in bytes, encode time and decode time in milliseconds
+    """
+    input_ids = np.random.randint(0, vocab_size, size=(batch_size, seq_len), dtype=np.int64)
+    attention_mask = np.ones((batch_size, seq_len), dtype=np.int64)
+    formats = {
+        'json': (lambda: json.dumps({"data": [input_ids.tolist(), attention_mask.tolist()], "model": "bench"}).encode('utf-8'),
+                 lambda payload: [np.asarray(array) for array in json.loads(payload)["data"]]),
+        'binary': (lambda: encode_arrays([input_ids.astype('<i4'), attention_mask.astype('<u1')], model="bench"),
+                   lambda payload: decode_arrays(payload)[0]),
+    }
+    results = {}
+    for name, (encode, decode) in formats.items():
+        start = time.perf_counter()
+        for _ in range(nb_repeats):
+            payload = encode()
+        encode_ms = 1000 * (time.perf_counter() - start) / nb_repeats
+        start = time.perf_counter()
+        for _ in range(nb_repeats):
+            decode(payload)
+        decode_ms = 1000 * (time.perf_counter() - start) / nb_repeats
+        results[name] = {'size': len(payload), 'encode_ms': encode_ms, 'decode_ms': decode_ms}
+        print(f'{name:>6}: {len(payload):>8} bytes - encode {encode_ms:.3f}ms - decode {decode_ms:.3f}ms')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark json and binary wire formats')
+    parser.add_argument("--batch_size", type=int, default=4, help="Number of sequences in a batch")
+    parser.add_argument("--seq_len", type=int, default=500, help="Length of the sequences")
+    args = parser.parse_args()
+    benchmark(batch_size=args.batch_size, seq_len=args.seq_len)
@@ -4,8 +4,8 @@ import os
 import argparse
 import copy
 import logging
+import tempfile
 import time
-import s3fs
 
 import mlflow
 import numpy as np
@@ -18,6 +18,10 @@ from sklearn.metrics import confusion_matrix, precision_recall_fscore_support
 from sklearn.model_selection import train_test_split
 from transformers import (AdamW, AutoModelForSequenceClassification, AutoTokenizer)
 
+from export import export_variants
+from mlflow_logger import BatchedMlflowLogger
+from s3_io import S3Store
+
 
 #%%
 ## Define logging behavior
@@ -46,6 +50,17 @@ parser.add_argument("--mlflow_experiment_name", help="Name of the experiment int
 parser.add_argument("--s3key", help="s3key", required=False, default=os.environ['AWS_ACCESS_KEY_ID'])
 parser.add_argument("--s3secret", help="s3secret", required=False, default=os.environ['AWS_SECRET_ACCESS_KEY'])
 parser.add_argument("--s3bucket", help="s3bucket", required=False, default=os.environ['AWS_BUCKET'])
+parser.add_argument("--s3endpoint", help="URL of an S3 compatible endpoint (MinIO, moto), AWS by default", required=False, default=os.environ.get('AWS_ENDPOINT_URL'))
+parser.add_argument("--s3cache_dir", help="Local directory caching downloaded S3 objects", required=False, default=None)
+parser.add_argument("--early_stopping_patience", help="Number of validations without improvement before stopping the training. If 0 (default), no early stopping", type=int, default = 0, required = False)
+parser.add_argument("--early_stopping_min_delta", help="Minimum change of the monitored metric to count as an improvement", type=float, default = 0.0, required = False)
+parser.add_argument("--early_stopping_metric", help="Metric monitored by early stopping, also used to keep the best checkpoint, 'val_f1' or 'val_loss'", choices=['val_f1', 'val_loss'], default = 'val_f1', required = False)
+parser.add_argument("--max_train_minutes", help="Wall-clock budget of the learning loop in minutes. If -1 (default), no limit", type=float, default = -1, required = False)
+parser.add_argument("--val_every_n_steps", help="Run a validation every N training steps in addition to the end of each epoch. If 0 (default), only at the end of each epoch", type=int, default = 0, required = False)
+parser.add_argument("--export_variants", help="Comma separated fast inference variants registered with the model, among 'int8' and 'torchscript'. Empty to disable", default = 'int8,torchscript', required = False)
+parser.add_argument("--export_f1_tolerance", help="Maximum test F1 drop accepted for an exported variant", type=float, default = 0.01, required = False)
+parser.add_argument("--mlflow_flush_interval", help="Maximum number of seconds metrics are buffered before being sent to mlflow", type=float, default = 5.0, required = False)
+parser.add_argument("--mlflow_queue_size", help="Maximum number of metrics waiting to be sent to mlflow before training blocks", type=int, default = 10000, required = False)
 
 training_params = vars(parser.parse_args()) # args to dict
 
@@ -59,22 +74,20 @@ s3bucket = training_params['s3bucket']
 s3bucket_train_csv = training_params['s3bucket_train_csv']
 s3bucket_test_csv = training_params['s3bucket_test_csv']
 
-## Connection using s3fs
-fs = s3fs.S3FileSystem(key=s3key, secret=s3secret)
-bucket_name = s3bucket
+## Connection to the datalake
+store = S3Store(s3bucket, key=s3key, secret=s3secret, endpoint_url=training_params['s3endpoint'], cache_dir=training_params['s3cache_dir'])
 
-train_csv = fs.ls(bucket_name + s3bucket_train_csv)[-1]
-test_csv = fs.ls(bucket_name + s3bucket_test_csv)[-1]
+train_csv = store.latest(s3bucket_train_csv, 'train.csv')
+test_csv = store.latest(s3bucket_test_csv, 'test.csv')
 
 print(train_csv)
 print(test_csv)
 
-with fs.open('s3://' + train_csv) as f:
-    train_init_df = pd.read_csv(f, sep='^([^,]+),', engine='python')
-    train_init_df = train_init_df[['label', 'text']]
-with fs.open('s3://' + test_csv) as f:    
-    test_df = pd.read_csv(f, sep='^([^,]+),', engine='python')
-    test_df = test_df[['label', 'text']]
+train_init_df = pd.read_csv(store.download(train_csv), sep='^([^,]+),', engine='python')
+train_init_df = train_init_df[['label', 'text']]
+test_df = pd.read_csv(store.download(test_csv), sep='^([^,]+),', engine='python')
+test_df = test_df[['label', 'text']]
+store.log_stats()
 
 print(train_init_df.head())
 print(test_df.head())
@@ -154,16 +167,41 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def train(train_loader, model, optimizer, mb):
+class EarlyStopping(object):
+    """Tells when the monitored metric has not improved by min_delta for patience validations"""
+    def __init__(self, patience=0, min_delta=0.0, mode='max'):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode
+        self.best = None
+        self.nb_bad_validations = 0
+
+    def step(self, value):
+        if self.best is None:
+            improved = True
+        elif self.mode == 'max':
+            improved = value > self.best + self.min_delta
+        else:
+            improved = value < self.best - self.min_delta
+        if improved:
+            self.best = value
+            self.nb_bad_validations = 0
+        else:
+            self.nb_bad_validations += 1
+        return self.patience > 0 and self.nb_bad_validations >= self.patience
+
+
+def train(train_loader, model, optimizer, mb, ml_logger=None, first_step=0, step_callback=None):
     model.train()
     
     loss_meter = AverageMeter()
     batch_time = AverageMeter()
     all_preds = []
     all_targets = []
+    stop_reason = None
     
     end = time.time()
-    for batch in progress_bar(train_loader, parent=mb):
+    for step, batch in enumerate(progress_bar(train_loader, parent=mb), first_step):
         input_ids = batch['input_ids'].to(device)
         attention_mask = batch['attention_mask'].to(device)
         labels = batch['label']
@@ -178,17 +216,30 @@ def train(train_loader, model, optimizer, mb):
         loss.backward()
         # update weights according to gradients
         optimizer.step()
-        batch_time.update(time.time() - end)
+        step_time = time.time() - end
+        batch_time.update(step_time)
         end = time.time()
         mb.child.comment = f'Loss: {loss_meter.avg:0.4f} - Batch time: {batch_time.avg:0.3f}'
+        # Log throughput of the step, buffered and sent in background
+        if ml_logger is not None:
+            ml_logger.log_metrics({'Train_step_loss': loss.item(),
+                                   'Train_step_time': step_time,
+                                   'Train_samples_per_s': input_ids.shape[0] / step_time if step_time > 0 else 0.0}, step)
         all_preds.append(preds.cpu().detach().numpy())
+        # Mid-epoch validation and time budget, may ask to stop the training
+        if step_callback is not None:
+            stop_reason = step_callback(step)
+            model.train()
+            end = time.time()
+            if stop_reason is not None:
+                break
         
     # Keep all predictions and targets to compute metrics after training
     all_preds = np.vstack(all_preds)
     all_preds = np.argmax(all_preds, axis=1)
     all_targets = np.vstack(all_targets)
     
-    return loss_meter.avg, all_preds, all_targets
+    return loss_meter.avg, all_preds, all_targets, stop_reason
 
 
 def test(test_loader, model, mb):
@@ -233,52 +284,125 @@ EXPERIMENT_NAME = training_params['mlflow_experiment_name']
 mlflow.set_experiment(EXPERIMENT_NAME)
 exp = client.get_experiment_by_name(EXPERIMENT_NAME)
 
-with mlflow.start_run() as run:
+with mlflow.start_run() as run, \
+        BatchedMlflowLogger(run.info.run_id, client, training_params['mlflow_queue_size'], training_params['mlflow_flush_interval']) as ml_logger:
     # Log hyperparameters into mlflow
-    mlflow.log_params(training_params),
-    mlflow.log_param('optimizer', type(optimizer).__name__) 
-    mlflow.log_params(optimizer.defaults)
-
-    best_epoch = -1
-    best_f_scores = 0.0
-    best_val_loss = 100
+    ml_logger.log_params(training_params)
+    ml_logger.log_param('optimizer', type(optimizer).__name__)
+    ml_logger.log_params(optimizer.defaults)
+
+    best = {'monitored': None, 'f1': 0.0, 'val_loss': 100, 'epoch': -1, 'model': None}
+    last_validation = {}
+    early_stopping = EarlyStopping(training_params['early_stopping_patience'],
+                                   training_params['early_stopping_min_delta'],
+                                   'max' if training_params['early_stopping_metric'] == 'val_f1' else 'min')
+    nb_steps_per_epoch = len(train_dataloader)
+    nb_planned_steps = training_params['nb_train_epochs'] * nb_steps_per_epoch
     mb = master_bar(range(training_params['nb_train_epochs']))
     since = time.time()
+    deadline = since + training_params['max_train_minutes'] * 60 if training_params['max_train_minutes'] > 0 else None
+
+    def validate(step, mb=None):
+        """Evaluate on val_dataset, keep the best model and tell if early stopping is triggered"""
+        avg_val_loss, val_preds, val_targets = test(val_dataloader, model, mb)
+        _, _, f_scores_val, _ = precision_recall_fscore_support(val_targets, val_preds, average = "weighted")
+        # Keep best_model, best val metric and loss in memory, the best checkpoint is chosen by the metric monitored by early stopping
+        monitored = f_scores_val if training_params['early_stopping_metric'] == 'val_f1' else avg_val_loss
+        if best['model'] is None or (monitored > best['monitored'] if early_stopping.mode == 'max' else monitored < best['monitored']):
+            best.update(monitored=monitored, f1=f_scores_val, val_loss=avg_val_loss, epoch=(step + 1) / nb_steps_per_epoch, model=copy.deepcopy(model))
+        stop = early_stopping.step(monitored)
+        last_validation['result'] = (avg_val_loss, f_scores_val, val_preds, val_targets, stop)
+        return last_validation['result']
+
+    def on_train_step(step):
+        """Run mid-epoch validation and check the time budget, return the stop reason if any"""
+        if training_params['val_every_n_steps'] > 0 and (step + 1) % training_params['val_every_n_steps'] == 0 \
+                and (step + 1) % nb_steps_per_epoch != 0:
+            step_val_loss, step_f_scores_val, _, _, stop = validate(step)
+            ml_logger.log_metrics({'Step_val_loss': step_val_loss, 'Step_val_f1_weighted': step_f_scores_val}, step)
+            if stop:
+                return 'early_stopping'
+        if deadline is not None and time.time() > deadline:
+            return 'time_budget'
+        return None
+
     # Learning loop
+    stop_reason = 'completed'
+    nb_done_steps = 0
     for epoch in mb:
         start_time = time.time()
 
-        avg_loss, train_preds, train_targets = train(train_dataloader, model, optimizer, mb)
-        avg_val_loss, val_preds, val_targets = test(val_dataloader, model, mb)
+        avg_loss, train_preds, train_targets, step_stop_reason = train(train_dataloader, model, optimizer, mb, ml_logger, epoch * nb_steps_per_epoch, on_train_step)
+        train_time = time.time() - start_time
+        nb_done_steps = epoch * nb_steps_per_epoch + int(np.ceil(len(train_targets) / training_params['train_batchsize']))
+        if step_stop_reason == 'early_stopping':
+            # The mid-epoch validation that triggered early stopping already evaluated the current weights
+            avg_val_loss, f_scores_val, val_preds, val_targets, stop = last_validation['result']
+        else:
+            # Validation at the end of the epoch, or of the last steps when the time budget stops the training mid-epoch
+            avg_val_loss, f_scores_val, val_preds, val_targets, stop = validate(nb_done_steps - 1, mb)
         # Compute metrics according predictions and targets
         _, _, f_scores_train, _ = precision_recall_fscore_support(train_targets, train_preds, average = "weighted")
-        _, _, f_scores_val, _ = precision_recall_fscore_support(val_targets, val_preds, average = "weighted")
 
         elapsed = time.time() - start_time
-        # Keep best_model, best val metric and loss in memory
-        if best_f_scores < f_scores_val:
-            best_f_scores = f_scores_val
-            best_val_loss = avg_val_loss
-            best_epoch = epoch + 1
-            best_model = copy.deepcopy(model)
         # Log training steps
         # logger.info(f'Epoch {epoch+1} - Train_loss: {avg_loss:.4f} - Train_f1: {f_scores_train:.4f} Val_loss: {avg_val_loss:.4f}  Val_f1: {f_scores_val:.4f} time: {elapsed:.0f}s')
         mb.write(f'Epoch {epoch+1} - Train_loss: {avg_loss:.4f} - Train_f1: {f_scores_train:.4f} Val_loss: {avg_val_loss:.4f}  Val_f1: {f_scores_val:.4f} time: {elapsed:.0f}s')
-        mlflow.log_metric('Train_loss', avg_loss, epoch)
-        mlflow.log_metric('Val_loss', avg_val_loss, epoch)
-        mlflow.log_metric('Train_f1_weighted', f_scores_train, epoch)
-        mlflow.log_metric('Val_f1_weighted', f_scores_val, epoch)
+        ml_logger.log_metrics({'Train_loss': avg_loss,
+                               'Val_loss': avg_val_loss,
+                               'Train_f1_weighted': f_scores_train,
+                               'Val_f1_weighted': f_scores_val,
+                               'Epoch_time': elapsed,
+                               'Train_epoch_samples_per_s': len(train_targets) / train_time}, epoch)
+        if step_stop_reason is not None:
+            stop_reason = step_stop_reason
+        elif stop:
+            stop_reason = 'early_stopping'
+        if stop_reason != 'completed':
+            mb.write(f'Stopping the training after epoch {epoch+1}: {stop_reason}')
+            break
     time_elapsed = time.time() - since
-    # Log best val f1 and register best model into mlflow repository
-    mlflow.log_metric('Training_time',time_elapsed)
-    mlflow.log_metric('Best_val_f1',best_f_scores)
-    mlflow.log_metric('Best_epoch',best_epoch)
-    mlflow.pytorch.log_model(best_model, "pytorch-model", registered_model_name="model_imdb")
+    best_model = best['model'] if best['model'] is not None else copy.deepcopy(model)
+    # Estimate the time saved from the average step time
+    time_saved = time_elapsed * (nb_planned_steps / nb_done_steps - 1) if nb_done_steps > 0 else 0.0
+    logger.info(f'Training stopped: {stop_reason} after {nb_done_steps}/{nb_planned_steps} steps, estimated time saved: {time_saved:.0f}s')
+    # Log the metrics of the best checkpoint, chosen by Checkpoint_metric, and register best model into mlflow repository
+    ml_logger.set_tag('Stop_reason', stop_reason)
+    ml_logger.set_tag('Checkpoint_metric', training_params['early_stopping_metric'])
+    ml_logger.log_metrics({'Training_time': time_elapsed,
+                           'Training_time_saved': time_saved,
+                           'Training_steps': nb_done_steps,
+                           'Best_val_f1': best['f1'],
+                           'Best_val_loss': best['val_loss'],
+                           'Best_epoch': best['epoch']})
     # Evaluate on test_dataset using the best model
     model = best_model
     avg_test_loss, test_preds, test_targets = test(test_dataloader, model, None)
     _, _, f_scores_test, _ = precision_recall_fscore_support(test_targets, test_preds, average = "weighted")
     # Log final test metric
-    mlflow.log_metric('Final_test_f1',f_scores_test)
+    ml_logger.log_metric('Final_test_f1', f_scores_test)
     logger.info(f'F1 Score Weighted on Test: {f_scores_test}')
+    # Export fast inference variants, checked and benchmarked on test_dataset
+    variants = [variant for variant in training_params['export_variants'].split(',') if variant]
+    # Variant files are copied by log_model, the directory is removed afterwards
+    with tempfile.TemporaryDirectory() as export_dir:
+        export_report = export_variants(best_model, test_dataloader, export_dir, variants, training_params['export_f1_tolerance'])
+        for variant, info in export_report['variants'].items():
+            if 'error' in info:
+                continue
+            ml_logger.log_metrics({f'Export_{variant}_test_f1': info['test_f1'],
+                                   f'Export_{variant}_latency_ms': info['latency_ms'],
+                                   f'Export_{variant}_size_mb': info['size_mb']})
+        # Send buffered metrics before the model upload
+        ml_logger.flush()
+        # Register the raw model with its variants as extra files, so they share the same model version
+        mlflow.pytorch.log_model(best_model, "pytorch-model", registered_model_name="model_imdb", extra_files=export_report['files'])
+    for model_version in client.search_model_versions(f"run_id='{run.info.run_id}'"):
+        if model_version.name != "model_imdb":
+            continue
+        client.set_model_version_tag(model_version.name, model_version.version, 'fastest_variant', export_report['fastest'])
+        for variant, info in export_report['variants'].items():
+            if info['accepted'] and variant != 'fp32':
+                client.set_model_version_tag(model_version.name, model_version.version, f'variant_{variant}', 'extra_files/' + info['file'])
+    logger.info(f"Fastest accepted variant: {export_report['fastest']}")
     print(confusion_matrix(val_targets, val_preds))
@@ -0,0 +1,143 @@
+import copy
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+from sklearn.metrics import precision_recall_fscore_support
+
+logger = logging.getLogger(__name__)
+
+# Variants that can be exported next to the raw pytorch model
+EXPORT_VARIANTS = ['int8', 'torchscript']
+VARIANT_FILES = {'fp32': 'model_fp32.pt', 'int8': 'model_int8.pt', 'torchscript': 'model_torchscript.pt'}
+
+
+class LogitsModel(torch.nn.Module):
+    """Wrap a huggingface classification model so that it takes positional inputs and returns only logits"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids, attention_mask=attention_mask)["logits"]
+
+
+def quantize_int8(model):
+    """
+    Dynamically quantize the linear layers of a model to int8
+    :param model: torch.nn.Module, model to quantize, left unchanged
+    :return: LogitsModel, quantized model on cpu
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return LogitsModel(torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8))
+
+
+def to_torchscript(model, example_batch):
+    """
+    Trace a model into TorchScript
+    :param model: torch.nn.Module, model to trace, left unchanged
+    :param example_batch: dict, batch with 'input_ids' and 'attention_mask' tensors used for tracing
+    :return: torch.jit.ScriptModule, traced model on cpu
+    """
+    logits_model = LogitsModel(copy.deepcopy(model).cpu().eval()).eval()
+    with torch.no_grad():
+        return torch.jit.trace(logits_model, (example_batch['input_ids'], example_batch['attention_mask']),
+                               check_trace=False)
+
+
+def benchmark(logits_model, loader):
+    """
+    Compute the weighted F1 and the latency of a model on cpu
+    :param logits_model: callable, takes input_ids and attention_mask and returns logits
+    :param loader: torch.utils.data.DataLoader, batches with 'input_ids', 'attention_mask' and 'label'
+    :return: tuple, weighted F1 and mean latency per batch in milliseconds
+    """
+    all_preds = []
+    all_targets = []
+    latencies = []
+    with torch.no_grad():
+        for batch in loader:
+            start = time.perf_counter()
+            logits = logits_model(batch['input_ids'], batch['attention_mask'])
+            latencies.append(time.perf_counter() - start)
+            all_preds.append(np.argmax(logits.numpy(), axis=1))
+            all_targets.append(batch['label'].numpy())
+    _, _, f_scores, _ = precision_recall_fscore_support(np.concatenate(all_targets), np.concatenate(all_preds),
+                                                        average="weighted")
+    return f_scores, 1000 * float(np.mean(latencies))
+
+
+def save_variant(variant_model, variant, output_dir):
+    """
+    Save a variant into output_dir
+    :param variant_model: torch.nn.Module, model to save
+    :param variant: string, name of the variant
+    :param output_dir: string, directory where the file is written
+    :return: string, path of the file
+    """
+    path = os.path.join(output_dir, VARIANT_FILES[variant])
+    if isinstance(variant_model, torch.jit.ScriptModule):
+        torch.jit.save(variant_model, path)
+    else:
+        # Save the huggingface model itself so that loading does not depend on this module
+        torch.save(variant_model.model if isinstance(variant_model, LogitsModel) else variant_model, path)
+    return path
+
+
+def export_variants(model, loader, output_dir, variants=EXPORT_VARIANTS, f1_tolerance=0.01):
+    """
+    Export fast inference variants of a model, check their F1 against the full precision model and benchmark them
+    :param model: torch.nn.Module, full precision huggingface model
+    :param loader: torch.utils.data.DataLoader, test split used to check accuracy and latency
+    :param output_dir: string, directory where variants and report are written
+    :param variants: list, variants to export among EXPORT_VARIANTS
+    :param f1_tolerance: float, maximum F1 drop accepted for a variant
+    :return: dict, report with metrics of each variant, the fastest accepted variant and the files to log
+    """
+    for variant in variants:
+        if variant not in EXPORT_VARIANTS:
+            raise ValueError(f"Unknown export variant: [{variant}], must be one of {EXPORT_VARIANTS}")
+
+    # Variants are optional optimisations, a variant failing to build or run is reported and skipped
+    builders = {'fp32': lambda: LogitsModel(copy.deepcopy(model).cpu().eval()).eval(),
+                'int8': lambda: quantize_int8(model),
+                'torchscript': lambda: to_torchscript(model, next(iter(loader)))}
+    report = {'variants': {}, 'fastest': 'fp32', 'files': []}
+    for variant in ['fp32'] + [variant for variant in variants if variant != 'fp32']:
+        try:
+            variant_model = builders[variant]()
+            f_scores, latency_ms = benchmark(variant_model, loader)
+            path = save_variant(variant_model, variant, output_dir)
+        except Exception as e:
+            logger.warning(f"Variant {variant} could not be exported: {e}")
+            report['variants'][variant] = {'accepted': False, 'error': f'{type(e).__name__}: {e}'}
+            continue
+        report['variants'][variant] = {'test_f1': f_scores,
+                                       'latency_ms': latency_ms,
+                                       'size_mb': os.path.getsize(path) / 2 ** 20,
+                                       'file': os.path.basename(path)}
+        logger.info(f'Variant {variant} - Test_f1: {f_scores:.4f} - Latency: {latency_ms:.2f}ms/batch')
+
+    reference = report['variants']['fp32']
+    for variant, info in report['variants'].items():
+        if 'error' in info:
+            continue
+        # Without the full precision reference the F1 drop of a variant cannot be checked
+        info['accepted'] = 'error' not in reference and reference['test_f1'] - info['test_f1'] <= f1_tolerance
+        if not info['accepted']:
+            logger.warning(f"Variant {variant} rejected, F1 drop is above {f1_tolerance}")
+            continue
+        if variant != 'fp32':
+            report['files'].append(os.path.join(output_dir, info['file']))
+        fastest = report['variants'][report['fastest']]
+        if 'error' in fastest or info['latency_ms'] < fastest['latency_ms']:
+            report['fastest'] = variant
+
+    report_path = os.path.join(output_dir, 'export_report.json')
+    with open(report_path, 'w') as f:
+        json.dump({'variants': report['variants'], 'fastest': report['fastest']}, f, indent=2)
+    report['files'].append(report_path)
+    return report
@@ -0,0 +1,184 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.tracking import MlflowClient
+
+logger = logging.getLogger(__name__)
+
+# Limits of a single mlflow log_batch request
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_PER_BATCH = 100
+MAX_ENTITIES_PER_BATCH = 1000
+# Minimum number of seconds between two warnings about a full queue
+STALL_WARNING_INTERVAL = 60.0
+
+_FLUSH = "flush"
+_CLOSE = "close"
+
+
+class BatchedMlflowLogger(object):
+    """
+    Buffer metrics, params and tags and send them to mlflow with log_batch from a background thread,
+    so that a slow tracking server does not stall the training loop
+    """
+    def __init__(self, run_id, client=None, max_queue_size=10000, flush_interval=5.0):
+        """
+        :param run_id: string, ID of the mlflow run to log into
+        :param client: MlflowClient, client to use, a new one is created by default
+        :param max_queue_size: int, maximum number of pending entries before log calls block
+        :param flush_interval: float, maximum number of seconds an entry waits before being sent
+        """
+        self.run_id = run_id
+        self.client = client if client is not None else MlflowClient()
+        self.flush_interval = flush_interval
+        self.nb_sent = 0
+        self.nb_errors = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._last_stall_warning = None
+        self._nb_blocked = 0
+        self._thread = threading.Thread(target=self._run, name="mlflow-logger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _put(self, item):
+        if self._closed:
+            raise RuntimeError("BatchedMlflowLogger is closed")
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # The queue is drained at each request to the tracking server, so a stalled server fills it again
+            # between two requests: warn at most every STALL_WARNING_INTERVAL instead of for every blocked entry
+            self._nb_blocked += 1
+            now = time.time()
+            if self._last_stall_warning is None or now - self._last_stall_warning >= STALL_WARNING_INTERVAL:
+                self._last_stall_warning = now
+                logger.warning(f"mlflow logging queue is full, waiting for the tracking server ... "
+                               f"({self._nb_blocked} entries blocked so far)")
+            self._queue.put(item)
+
+    def log_metric(self, key, value, step=None):
+        """
+        Queue a metric
+        :param key: string, name of the metric
+        :param value: float, value of the metric
+        :param step: int, step of the metric, 0 by default
+        """
+        self._put(Metric(key, float(value), int(time.time() * 1000), step or 0))
+
+    def log_metrics(self, metrics, step=None):
+        """
+        Queue several metrics sharing the same step
+        :param metrics: dict, metric name to value
+        :param step: int, step of the metrics, 0 by default
+        """
+        timestamp = int(time.time() * 1000)
+        for key, value in metrics.items():
+            self._put(Metric(key, float(value), timestamp, step or 0))
+
+    def log_param(self, key, value):
+        """
+        Queue a param
+        :param key: string, name of the param
+        :param value: any, value of the param, converted to string
+        """
+        self._put(Param(key, str(value)))
+
+    def log_params(self, params):
+        """
+        Queue several params
+        :param params: dict, param name to value
+        """
+        for key, value in params.items():
+            self.log_param(key, value)
+
+    def set_tag(self, key, value):
+        """
+        Queue a tag
+        :param key: string, name of the tag
+        :param value: any, value of the tag, converted to string
+        """
+        self._put(RunTag(key, str(value)))
+
+    def flush(self, timeout=None):
+        """
+        Send every queued entry and wait until they are sent
+        :param timeout: float, maximum number of seconds to wait, no limit by default
+        :return: bool, True if every entry has been sent before the timeout
+        """
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Flush every queued entry and stop the background thread
+        :param timeout: float, maximum number of seconds to wait, no limit by default
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_CLOSE, None))
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+        if self.nb_errors:
+            logger.warning(f"{self.nb_errors} mlflow log_batch request(s) failed")
+
+    def _send(self, metrics, params, tags):
+        while metrics or params or tags:
+            # mlflow also limits the total number of metrics, params and tags of a request
+            params_chunk, params = params[:MAX_PARAMS_PER_BATCH], params[MAX_PARAMS_PER_BATCH:]
+            tags_chunk, tags = tags[:MAX_PARAMS_PER_BATCH], tags[MAX_PARAMS_PER_BATCH:]
+            nb_metrics = min(MAX_METRICS_PER_BATCH, MAX_ENTITIES_PER_BATCH - len(params_chunk) - len(tags_chunk))
+            metrics_chunk, metrics = metrics[:nb_metrics], metrics[nb_metrics:]
+            nb_entries = len(metrics_chunk) + len(params_chunk) + len(tags_chunk)
+            try:
+                self.client.log_batch(self.run_id, metrics=metrics_chunk, params=params_chunk, tags=tags_chunk)
+                self.nb_sent += nb_entries
+            except Exception as e:
+                # Never break the training because of the tracking server
+                self.nb_errors += 1
+                logger.warning(f"Error when sending {nb_entries} entries to mlflow: {e}")
+
+    def _run(self):
+        metrics, params, tags = [], [], []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, Metric):
+                metrics.append(item)
+            elif isinstance(item, Param):
+                params.append(item)
+            elif isinstance(item, RunTag):
+                tags.append(item)
+
+            must_send = (item is None or isinstance(item, tuple) or time.time() >= deadline
+                         or len(metrics) + len(params) + len(tags) >= MAX_ENTITIES_PER_BATCH
+                         or len(params) >= MAX_PARAMS_PER_BATCH or len(tags) >= MAX_PARAMS_PER_BATCH)
+            if must_send:
+                self._send(metrics, params, tags)
+                metrics, params, tags = [], [], []
+                deadline = time.time() + self.flush_interval
+
+            if isinstance(item, tuple):
+                command, done = item
+                if command == _CLOSE:
+                    return
+                done.set()